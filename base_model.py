@@ -1,6 +1,8 @@
 import os
 import sys
 import json
+import time
+import threading
 import numpy as np
 import pandas as pd
 import tensorflow as tf
@@ -9,18 +11,28 @@ import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 from tqdm import tqdm
 import skimage.transform
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 
 from dataset import *
 from utils.words import *
+from utils.store import *
+from utils.records import *
 from utils.vqa.vqa import *
 from utils.vqa.vqaEval import *
 
 class ImageLoader(object):
-    def __init__(self, mean_file):
+    def __init__(self, mean_file, num_threads=1):
         self.bgr = True 
         self.scale_shape = np.array([224, 224], np.int32)
         self.crop_shape = np.array([224, 224], np.int32)
         self.mean = np.load(mean_file).mean(1).mean(1)
+        self.pool = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+        self.num_loaded = 0
+        self.load_time = 0.0
+        self.num_loading = 0
+        self.busy_since = 0.0
+        self.stats_lock = threading.Lock()
 
     def load_img(self, img_file):      
         """ Load and preprocess an image. """
@@ -38,192 +50,417 @@ class ImageLoader(object):
         img = img - self.mean
         return img
 
+    def decode_img(self, img_file, buf):
+        """ Load, resize and crop an image into a slot of a uint8 batch buffer. """
+        img = Image.open(img_file)
+        img.draft('RGB', (int(self.scale_shape[0]), int(self.scale_shape[1])))
+        img = np.asarray(img.convert('RGB'))
+
+        if not self.bgr:
+            img = img[:, :, ::-1]
+
+        img = cv2.resize(img, (self.scale_shape[0], self.scale_shape[1]))
+        offset = (self.scale_shape - self.crop_shape) / 2
+        offset = offset.astype(np.int32)
+        buf[...] = img[offset[0]:offset[0]+self.crop_shape[0], offset[1]:offset[1]+self.crop_shape[1], :]
+
     def load_imgs(self, img_files):
-        """ Load and preprocess a list of images. """
-        imgs = []
-        for img_file in img_files:
-            imgs.append(self.load_img(img_file))
-        imgs = np.array(imgs, np.float32)
+        """ Load, resize and crop a list of images into a uint8 batch. """
+        self.start_loading()
+        imgs = np.empty([len(img_files), self.crop_shape[0], self.crop_shape[1], 3], np.uint8)
+        if self.pool is None:
+            for img_file, buf in zip(img_files, imgs):
+                self.decode_img(img_file, buf)
+        else:
+            list(self.pool.map(self.decode_img, img_files, imgs))
+
+        self.stop_loading(len(img_files))
         return imgs
 
+    def start_loading(self):
+        """ Mark the start of the loading of a batch. """
+        # Batches may be loaded concurrently, so only the wall-clock time during which any batch is loading is counted
+        with self.stats_lock:
+            if self.num_loading == 0:
+                self.busy_since = time.time()
+            self.num_loading += 1
+
+    def stop_loading(self, num_imgs):
+        """ Mark the end of the loading of a batch of num_imgs images. """
+        with self.stats_lock:
+            self.num_loading -= 1
+            self.num_loaded += num_imgs
+            if self.num_loading == 0:
+                self.load_time += time.time() - self.busy_since
+
+    def imgs_per_sec(self):
+        """ Get the loading throughput so far (over the wall-clock time spent loading). """
+        with self.stats_lock:
+            return self.num_loaded / self.load_time if self.load_time > 0 else 0.0
+
+    def load_unique_imgs(self, img_files):
+        """ Load and preprocess each distinct image of a list only once, and get the index of the image of each entry. """
+        unique_files, img_idxs = np.unique(img_files, return_inverse=True)
+        imgs = self.load_imgs(unique_files)
+        return imgs, img_idxs
+
 
 class BaseModel(object):
     def __init__(self, params, mode):
         self.params = params
         self.mode = mode
-        self.batch_size = params.batch_size if mode=='train' else 1
 
         self.cnn_model = params.cnn_model
         self.save_cnn_dir = "./tfmodels/updated/%s" %(self.cnn_model)
         self.train_cnn = params.train_cnn
+        self.facts_only = params.facts_only
+        if self.facts_only and self.train_cnn:
+            print("Error: The CNN cannot be trained in facts-only mode.")
+            sys.exit(0)
+        self.use_feat_cache = (params.use_feat_cache or self.facts_only) and not self.train_cnn
+        self.use_img_store = params.use_img_store and not self.use_feat_cache
+        self.use_records = params.use_records and mode == 'train' and not self.facts_only
+        self.feat_dtype = np.float16 if params.feat_dtype == 'float16' else np.float32
+        self.pca_dim = params.pca_dim
+        if self.pca_dim > 0 and (not self.use_feat_cache or self.use_records):
+            print("Error: The facts can only be projected with PCA when they come from the feature cache.")
+            sys.exit(0)
 
         self.save_dir = os.path.join(params.save_dir, self.cnn_model+'/')
+        self.frozen_cnn_file = os.path.join(self.save_dir, 'frozen_cnn', 'cnn')
+        self.frozen_cnn_saved = False
+        self.cnn_pending = False
         self.class_balancing_factor = params.class_balancing_factor
 
-        self.img_loader = ImageLoader(params.mean_file)
+        self.img_loader = ImageLoader(params.mean_file, params.num_load_threads)
         self.img_shape = [224, 224, 3]
 
         self.word_table = WordTable(params.dim_embed, params.max_ques_len, params.word_table_file)
         self.word_table.load()
 
+        self.answer_table = AnswerTable(params.max_answers, params.answer_table_file)
+        try:
+            self.answer_table.load()
+        except ValueError as e:
+            print("Error: %s Please use the same --max_answers as in training." %(e))
+            sys.exit(0)
+
         self.global_step = tf.Variable(0, name='global_step', trainable=False)
+        if self.use_records:
+            self.record_files = get_record_files(params.record_dir, 'train', params.num_shards)
+            self.record_meta_file = get_meta_file(params.record_dir, 'train')
+            self.record_iterator = read_records(self.record_files, self.img_shape, params.batch_size, True, params.shuffle_size, params.num_readers, params.prefetch_size)
+            self.record_batch = self.record_iterator.get_next()
         self.build()
-        self.saver = tf.train.Saver(max_to_keep=100)
+        self.saver = tf.train.Saver(self.get_saved_vars(), max_to_keep=100)
+        self.frozen_cnn_saver = tf.train.Saver(self.cnn_vars) if not self.train_cnn and len(self.cnn_vars) > 0 else None
 
     def build(self):
         raise NotImplementedError()
 
-    def get_feed_dict(self, batch, is_train, feats=None):
+    def get_saved_vars(self):
+        """ Get the variables saved with the model, which leave out a frozen CNN. """
+        if self.train_cnn:
+            return tf.global_variables()
+        cnn_var_names = set(v.name for v in self.cnn_vars)
+        return [v for v in tf.global_variables() if v.name not in cnn_var_names]
+
+    def get_feed_dict(self, prepared_batch, is_train, feats=None):
         raise NotImplementedError()
 
+    def get_fact_shape(self):
+        """ Get the shape of the facts fed to the RNN: The shape of the CNN features, or their projection with PCA. """
+        num_facts, dim_fact = self.conv_feat_shape
+        if self.pca_dim > 0:
+            dim_fact = self.pca_dim
+        return [num_facts, dim_fact]
+
+    def get_feat_store_name(self, name):
+        """ Get the name of the feature cache of a split, which depends on the CNN, the projection and the stored type. """
+        store_name = name+'_'+self.cnn_model
+        if self.pca_dim > 0:
+            store_name += '_pca%d' %(self.pca_dim)
+        if self.feat_dtype == np.float16:
+            store_name += '_fp16'
+        return store_name
+
+    def prepare_feats(self, sess, data, name):
+        """ Run the CNN once over all images of the dataset, and cache their features on disk. """
+        num_facts, dim_fact = self.get_fact_shape()
+        feat_store = FeatureStore(self.params.feat_cache_dir, self.get_feat_store_name(name), num_facts, dim_fact, self.feat_dtype)
+
+        if not feat_store.exists(data.image_ids, data.img_files):
+            if self.facts_only:
+                print("Error: No cached CNN features found in %s. Please extract them first without --facts_only." %(self.params.feat_cache_dir))
+                sys.exit(0)
+            if self.cnn_pending:
+                self.restore_cnn(sess)
+            projection = self.prepare_projection(sess, data, name) if self.pca_dim > 0 else None
+
+            print("Extracting the CNN features...")
+            image_ids, idx = np.unique(data.image_ids, return_index=True)
+            img_files = data.img_files[idx]
+            feat_store.create(image_ids, img_files)
+
+            batch_size = self.params.batch_size
+            for start in tqdm(list(range(0, len(img_files), batch_size)), desc='extract'):
+                imgs = self.img_loader.load_imgs(img_files[start:start+batch_size])
+                feats = sess.run(self.conv_feats, feed_dict={self.imgs:imgs, self.is_train:False})
+                if projection is not None:
+                    feats = projection.project(feats)
+                feat_store.write(start, feats)
+
+            feat_store.finish()
+            print("CNN features extracted.")
+
+        feat_store.load()
+        return feat_store
+
+    def prepare_projection(self, sess, data, name):
+        """ Fit the PCA projection of the facts on a sample of the training images, or load it. """
+        projection = FactProjection(self.params.feat_cache_dir, self.cnn_model, self.pca_dim)
+        if projection.exists():
+            projection.load()
+            return projection
+        if name != 'train':
+            print("Error: No PCA projection of the facts found in %s. Please train first." %(self.params.feat_cache_dir))
+            sys.exit(0)
+
+        print("Fitting the PCA projection of the facts...")
+        image_ids, idx = np.unique(data.image_ids, return_index=True)
+        img_files = data.img_files[idx]
+        sample_size = min(self.params.pca_sample_size, len(img_files))
+        img_files = img_files[np.random.RandomState(0).choice(len(img_files), sample_size, replace=False)]
+
+        batch_size = self.params.batch_size
+        for start in tqdm(list(range(0, len(img_files), batch_size)), desc='pca'):
+            imgs = self.img_loader.load_imgs(img_files[start:start+batch_size])
+            projection.accumulate(sess.run(self.conv_feats, feed_dict={self.imgs:imgs, self.is_train:False}))
+        projection.fit()
+        projection.save()
+        print("PCA projection fitted. Explained variance = %.3f" %(projection.explained_variance))
+        return projection
+
+    def prepare_imgs(self, data, name):
+        """ Decode, resize and crop all images of the dataset once, and store them on disk as uint8. """
+        img_store = ImageStore(self.params.img_store_dir, name, self.img_shape)
+
+        if not img_store.exists(data.image_ids, data.img_files):
+            print("Converting the images...")
+            image_ids, idx = np.unique(data.image_ids, return_index=True)
+            img_files = data.img_files[idx]
+            img_store.create(image_ids, img_files)
+
+            batch_size = self.params.batch_size
+            for start in tqdm(list(range(0, len(img_files), batch_size)), desc='convert'):
+                img_store.write(start, self.img_loader.load_imgs(img_files[start:start+batch_size]))
+
+            img_store.finish()
+            print("Images converted.")
+
+        img_store.load()
+        return img_store
+
+    def prepare_batch(self, batch, is_train, feat_store=None, img_store=None):
+        """ Load the images (or the cached features) of a batch, and compute its answer weights. """
+        img_files, image_ids = batch[0], batch[1]
+        imgs, img_idxs, feats, answer_weights = None, None, None, None
+        if feat_store is not None:
+            feats = feat_store.get(image_ids)
+        elif img_store is not None:
+            unique_ids, img_idxs = np.unique(image_ids, return_inverse=True)
+            imgs = img_store.get(unique_ids)
+        else:
+            imgs, img_idxs = self.img_loader.load_unique_imgs(img_files)
+        if is_train:
+            answer_weights = self.answer_weight[batch[4]]
+        return batch, imgs, img_idxs, feats, answer_weights
+
+    def get_feats(self, sess, prepared_batch):
+        """ Get the CNN features of a prepared batch, either from the feature cache or by running the CNN. """
+        _, imgs, img_idxs, feats, _ = prepared_batch
+        if feats is not None:
+            return feats
+        feats = sess.run(self.conv_feats, feed_dict={self.imgs:imgs, self.is_train:False})
+        return feats[img_idxs]
+
     def train(self, sess, train_vqa, train_data):
         """ Train the model. """
         print("Training the model...")
         params = self.params
         num_epochs = params.num_epochs
+        if self.use_records:
+            self.train_from_records(sess, train_data)
+            return
 
-        for epoch_no in tqdm(list(range(num_epochs)), desc='epoch'):
-            for idx in tqdm(list(range(train_data.num_batches)), desc='batch'):
-                batch = train_data.next_batch()
+        feat_store = self.prepare_feats(sess, train_data, 'train') if self.use_feat_cache else None
+        img_store = self.prepare_imgs(train_data, 'train') if self.use_img_store else None
+        prepare_fn = lambda batch: self.prepare_batch(batch, True, feat_store, img_store)
 
-                if self.train_cnn:
-                    # Train CNN and RNN 
-                    feed_dict = self.get_feed_dict(batch, is_train=True)
-                    summaries, _, loss0, loss1, global_step = sess.run([self.summaries, self.opt_op, self.loss0, self.loss1, self.global_step], feed_dict=feed_dict)
+        for epoch_no in tqdm(list(range(num_epochs)), desc='epoch'):
+            prefetcher = BatchPrefetcher(train_data, prepare_fn, train_data.num_batches, params.prefetch_size, params.num_prefetch_threads)
+            try:
+                for idx in tqdm(list(range(train_data.num_batches)), desc='batch'):
+                    batch = prefetcher.next_batch()
+
+                    if self.train_cnn:
+                        # Train CNN and RNN 
+                        feed_dict = self.get_feed_dict(batch, is_train=True)
+                        summaries, _, loss0, loss1, global_step = sess.run([self.summaries, self.opt_op, self.loss0, self.loss1, self.global_step], feed_dict=feed_dict)
  
-                else:              
-                    # Train RNN only 
-                    img_files, _, _, _ = batch
-                    imgs = self.img_loader.load_imgs(img_files)
-                    feats = sess.run(self.conv_feats, feed_dict={self.imgs:imgs, self.is_train:False})
-                    feed_dict = self.get_feed_dict(batch, is_train=True, feats=feats)
-                    summaries, _, loss0, loss1, global_step = sess.run([self.summaries, self.opt_op, self.loss0, self.loss1, self.global_step], feed_dict=feed_dict)
+                    else:              
+                        # Train RNN only 
+                        feats = self.get_feats(sess, batch)
+                        feed_dict = self.get_feed_dict(batch, is_train=True, feats=feats)
+                        summaries, _, loss0, loss1, global_step = sess.run([self.summaries, self.opt_op, self.loss0, self.loss1, self.global_step], feed_dict=feed_dict)
+
+                    print(" Loss0=%f Loss1=%f" %(loss0, loss1))
+                    self.summary_writer.add_summary(summaries, global_step)
+
+                    if (global_step + 1) % params.save_period == 0:
+                        self.save(sess)
+            finally:
+                prefetcher.close()
+
+            train_data.reset()
+            if self.img_loader.num_loaded > 0:
+                print("Image loading: %.1f images/sec" %(self.img_loader.imgs_per_sec()))
+
+        print("Training complete.")
+
+    def train_from_records(self, sess, train_data):
+        """ Train the model with the inputs read from the record files by the input pipeline instead of being fed. """
+        params = self.params
+
+        # The records hold symbolized questions and answers, so they are rewritten whenever the vocabularies or the questions change
+        meta = {'word_table': self.word_table.digest(),
+                'answer_table': self.answer_table.digest(),
+                'max_ques_len': params.max_ques_len,
+                'question_ids': digest_values(train_data.question_ids),
+                'image_ids': digest_values(train_data.image_ids),
+                'img_files': digest_values(train_data.img_files)}
+        if not records_exist(self.record_files, self.record_meta_file, meta):
+            print("Writing the record files...")
+            write_records(self.record_files, self.record_meta_file, meta, train_data, self.img_loader, params.batch_size)
+            print("Record files written.")
+
+        for epoch_no in tqdm(list(range(params.num_epochs)), desc='epoch'):
+            sess.run(self.record_iterator.initializer)
+            pbar = tqdm(total=train_data.num_batches, desc='batch')
+            while True:
+                try:
+                    summaries, _, loss0, loss1, global_step = sess.run([self.summaries, self.opt_op, self.loss0, self.loss1, self.global_step], feed_dict={self.is_train: True})
+                except tf.errors.OutOfRangeError:
+                    break
+                pbar.update(1)
 
                 print(" Loss0=%f Loss1=%f" %(loss0, loss1))
                 self.summary_writer.add_summary(summaries, global_step)
 
                 if (global_step + 1) % params.save_period == 0:
                     self.save(sess)
-
-            train_data.reset()
+            pbar.close()
 
         print("Training complete.")
 
+    def answer_batch(self, sess, batch, feat_store=None, img_store=None):
+        """ Answer a batch of questions, and get their probabilities and the attention of the last memory step. """
+        prepared_batch = self.prepare_batch(batch, False, feat_store, img_store)
+        if self.train_cnn: 
+            feed_dict = self.get_feed_dict(prepared_batch, is_train=False) 
+        else: 
+            feats = self.get_feats(sess, prepared_batch)
+            feed_dict = self.get_feed_dict(prepared_batch, is_train=False, feats=feats)
+
+        results, probs, attentions = sess.run([self.results, self.probs, self.attentions], feed_dict=feed_dict)
+        return results, probs, attentions
+
     def val(self, sess, val_vqa, val_data, show_result=False):
         """ Validate the model. """
         print("Validating the model...")
-        answers = []
         result_dir = self.params.val_result_dir
+        feat_store = self.prepare_feats(sess, val_data, 'val') if self.use_feat_cache else None
+        img_store = self.prepare_imgs(val_data, 'val') if self.use_img_store else None
+        scorer = VQAOnlineEval(val_vqa)
 
-        # Compute the answers to the questions
-        for k in tqdm(list(range(val_data.count))):
+        num_batches = val_data.num_batches
+        if self.params.num_val_batches > 0:
+            num_batches = min(num_batches, self.params.num_val_batches)
+
+        # Compute the answers to the questions, and score them as they come
+        pbar = tqdm(list(range(num_batches)))
+        for k in pbar:
             batch = val_data.next_batch()
-            img_files, questions, question_lens = batch
-
-            img_file = img_files[0]
-            img_name = os.path.splitext(img_file.split(os.sep)[-1])[0]
-
-            if self.train_cnn: 
-                feed_dict = self.get_feed_dict(batch, is_train=False) 
-            else: 
-                img_files, _, _ = batch 
-                imgs = self.img_loader.load_imgs(img_files)
-                feats = sess.run(self.conv_feats, feed_dict={self.imgs:imgs, self.is_train:False}) 
-                feed_dict = self.get_feed_dict(batch, is_train=False, feats=feats)
-
-            result = sess.run(self.results, feed_dict=feed_dict)
-            attention = sess.run(self.attend, feed_dict=feed_dict)
-            answer = self.word_table.idx2word[result.squeeze()]
-            answers.append({'question_id': val_data.question_ids[k], 'answer': answer})
-
-            # Save the result in an image file
-            question = questions[0]
-            q_len = question_lens[0]
-            q_words = ['Q:'] + [self.word_table.idx2word[question[i]] for i in range(q_len)]
-            if q_words[-1]!='?':
-                q_words.append('?')
-            ques = ' '.join(q_words)
-            a_words = ['A:'] + [answer]
-            ans = ' '.join(a_words)
-
-            img = mpimg.imread(img_file)
-            attention = np.array(attention).reshape(-1,1)[self.get_permutation(14,14)]
-            #attention=attention.squeeze()
-            attention=attention.reshape(14,14)
-            attention_img = skimage.transform.pyramid_expand(attention,
-                    upscale=32, sigma=20)
-            #print(img.shape)
-            #attention_value = pd.DataFrame(attention )
-            #attention_value.to_csv(os.path.join(result_dir,
-            #    img_name+'_'+str(val_data.question_ids[k])+'_result.csv'))
-            #attention_img = skimage.transform.rescale(attention,
-            #        (img.shape[0]/14, img.shape[1]/14))
-
-            plt.imshow(img)
-            plt.imshow(attention_img, alpha=0.85)
-            plt.axis('off')
-            plt.title(ques+'\n'+ans)
-            plt.savefig(os.path.join(result_dir, img_name+'_'+str(val_data.question_ids[k])+'_result.jpg'))
+            img_files, image_ids, questions, question_lens = batch
+            results, probs, attentions = self.answer_batch(sess, batch, feat_store, img_store)
+
+            question_ids = val_data.question_ids[k*val_data.batch_size:k*val_data.batch_size+len(results)]
+            answers = [self.answer_table.idx2ans[r] for r in results]
+            accuracy = scorer.update(question_ids, answers)
+            pbar.set_postfix(accuracy=accuracy['overall'])
+
+            for i in range(len(results)):
+                question_id = question_ids[i]
+                img_file = img_files[i]
+                img_name = os.path.splitext(img_file.split(os.sep)[-1])[0]
+
+                answer = answers[i]
+
+                # Save the result in an image file
+                question = questions[i]
+                q_len = question_lens[i]
+                q_words = ['Q:'] + [self.word_table.idx2word[question[j]] for j in range(q_len)]
+                if q_words[-1]!='?':
+                    q_words.append('?')
+                ques = ' '.join(q_words)
+                a_words = ['A:'] + [answer] + ['(%.2f)' %(probs[i])]
+                ans = ' '.join(a_words)
+
+                img = mpimg.imread(img_file)
+                attention = attentions[i].reshape(-1,1)[self.get_permutation(14,14)]
+                attention=attention.reshape(14,14)
+                attention_img = skimage.transform.pyramid_expand(attention,
+                        upscale=32, sigma=20)
+
+                plt.imshow(img)
+                plt.imshow(attention_img, alpha=0.85)
+                plt.axis('off')
+                plt.title(ques+'\n'+ans)
+                plt.savefig(os.path.join(result_dir, img_name+'_'+str(question_id)+'_result.jpg'))
 
         val_data.reset() 
 
-        # Evaluate these answers
-        val_res_vqa = val_vqa.loadRes2(answers)
-        scorer = VQAEval(val_vqa, val_res_vqa)
-        scorer.evaluate()
+        accuracy = scorer.getAccuracy()
+        print("Overall accuracy on %d questions = %f" %(scorer.numEvaluated(), accuracy['overall']))
+        for ans_type in sorted(accuracy['perAnswerType']):
+            print("Accuracy on %s answers = %f" %(ans_type, accuracy['perAnswerType'][ans_type]))
         print("Validation complete.")
 
     def test(self, sess, test_data):
         """ Test the model. """
         print("Testing the model...")
-        font = cv2.FONT_HERSHEY_COMPLEX        
         test_info_file = self.params.test_info_file
         result_file = self.params.test_result_file
-        result_dir = self.params.test_result_dir
 
         question_ids = []
         answers = []
+        answer_probs = []
+        feat_store = self.prepare_feats(sess, test_data, 'test') if self.use_feat_cache else None
+        img_store = self.prepare_imgs(test_data, 'test') if self.use_img_store else None
 
         # Compute the answers to the questions        
-        for k in tqdm(list(range(test_data.count))):
+        for k in tqdm(list(range(test_data.num_batches))):
             batch = test_data.next_batch()
-            img_files, questions, question_lens = batch
-
-            img_file = img_files[0]
-            img_name = os.path.splitext(img_file.split(os.sep)[-1])[0]
-
-            if self.train_cnn: 
-                feed_dict = self.get_feed_dict(batch, is_train=False) 
-            else: 
-                img_files, _, _ = batch 
-                imgs = self.img_loader.load_imgs(img_files)
-                feats = sess.run(self.conv_feats, feed_dict={self.imgs:imgs, self.is_train:False}) 
-                feed_dict = self.get_feed_dict(batch, is_train=False, feats=feats)            
-
-            result = sess.run(self.results, feed_dict=feed_dict)           
-            answer = self.word_table.idx2word[result.squeeze()]
-            answers.append(answer)
-            question_ids.append(test_data.question_ids[k])
-
-            # Save the result in an image file
-            question = questions[0]
-            q_len = question_lens[0]
-            q_words = ['Q:'] + [self.word_table.idx2word[question[i]] for i in range(q_len)]
-            if q_words[-1]!='?':
-                q_words.append('?')
-            ques = ' '.join(q_words)
-            a_words = ['A:'] + [answer]
-            ans = ' '.join(a_words)
-
-            #img = mpimg.imread(img_file)
-            #plt.imshow(img)
-            #plt.axis('off')
-            #plt.title(ques+'\n'+ans)
-            #plt.savefig(os.path.join(result_dir, img_name+'_'+str(test_data.question_ids[k])+'_result.jpg'))
+            results, probs, _ = self.answer_batch(sess, batch, feat_store, img_store)
+
+            for i in range(len(results)):
+                answers.append(self.answer_table.idx2ans[results[i]])
+                answer_probs.append(probs[i])
+                question_ids.append(test_data.question_ids[k*test_data.batch_size+i])
 
         # Save the answers to a file
         test_info = pd.read_csv(test_info_file)
-        results = pd.DataFrame({'question_id': question_ids, 'answer': answers})
+        results = pd.DataFrame({'question_id': question_ids, 'answer': answers, 'probability': answer_probs})
         results = pd.merge(test_info, results)
         results.to_csv(result_file)
         print("Testing complete.")
@@ -232,7 +469,17 @@ class BaseModel(object):
         """ Save the model. """
         print(("Saving model to %s" %self.save_dir))
         self.saver.save(sess, self.save_dir, self.global_step)
-        m_name=self.cnn_saver.save(sess, self.save_cnn_dir, self.global_step)
+        if self.train_cnn:
+            self.cnn_saver.save(sess, self.save_cnn_dir, self.global_step)
+        elif self.frozen_cnn_saver is not None and not self.frozen_cnn_saved:
+            # The frozen CNN does not change during training, so it is saved once per run
+            if self.cnn_pending:
+                self.restore_cnn(sess)
+            frozen_cnn_dir = os.path.dirname(self.frozen_cnn_file)
+            if not os.path.exists(frozen_cnn_dir):
+                os.makedirs(frozen_cnn_dir)
+            self.frozen_cnn_saver.save(sess, self.frozen_cnn_file)
+            self.frozen_cnn_saved = True
         if self.params.save_embed :
             with tf.variable_scope('embedding', reuse=True):
                 matrix=tf.get_variable('emb_w', [self.word_table.num_words, self.params.dim_embed ])
@@ -249,36 +496,56 @@ class BaseModel(object):
             print("Error: No saved model found. Please train first.")
             sys.exit(0)
         self.saver.restore(sess, checkpoint.model_checkpoint_path)
+        self.checkpoint_path = checkpoint.model_checkpoint_path
+
+        # With the feature cache, a frozen CNN is only restored once some features have to be extracted
+        self.cnn_pending = self.frozen_cnn_saver is not None
+        if self.cnn_pending and not self.use_feat_cache:
+            self.restore_cnn(sess)
+
+    def restore_cnn(self, sess):
+        """ Restore the frozen CNN saved with the model, or load the pretrained CNN model if there is none. """
+        if tf.train.checkpoint_exists(self.frozen_cnn_file):
+            print("Loading the frozen CNN from %s..." %(self.frozen_cnn_file))
+            self.frozen_cnn_saver.restore(sess, self.frozen_cnn_file)
+        elif all(tf.train.NewCheckpointReader(self.checkpoint_path).has_tensor(v.op.name) for v in self.cnn_vars):
+            # Older models were saved together with their frozen CNN
+            self.frozen_cnn_saver.restore(sess, self.checkpoint_path)
+        else:
+            print("No CNN saved with the model.")
+            self.load_cnn(sess)
+        self.cnn_pending = False
+
+    def load_cnn(self, sess):
+        """ Load the pretrained CNN model. """
+        if self.cnn_model == 'vgg16':
+            self.load2(self.params.cnn_model_file, sess)
+        else:
+            self.cnn_saver.restore(sess, self.params.cnn_model_file)
 
     def load2(self, data_path, session, ignore_missing=True):
-        """ Load a pretrained CNN model. """
+        """ Load a pretrained CNN model from a frozen graph into the CNN variables of the same layers and shapes. """
         print("Loading CNN model from %s..." %data_path)
         with open(data_path, mode='rb') as f:
-          fileContent = f.read()
-        
-        graph_def = tf.GraphDef()
-        graph_def.ParseFromString(fileContent)
-        session.graph.as_default()
-        tf.import_graph_def(graph_def,name='imported_CNN_model')
-        init = tf.global_variables_initializer()
-        session.run(init)
-        print("graph loaded from disk")
-        
-         #data_dict = np.load(data_path).item()
-         #count = 0
-         #miss_count = 0
-         #for op_name in data_dict:
-         #    with tf.variable_scope(op_name, reuse=True):
-         #        for param_name, data in data_dict[op_name].iteritems():
-         #            try:
-         #                var = tf.get_variable(param_name)
-         #                session.run(var.assign(data))
-         #                count += 1
-         #               #print("Variable %s:%s loaded" %(op_name, param_name))
-         #            except ValueError:
-         #                miss_count += 1
-         #               #print("Variable %s:%s missed" %(op_name, param_name))
-         #                if not ignore_missing:
-         #                    raise
-         #print("%d variables loaded. %d variables missed." %(count, miss_count))
+            graph_def = tf.GraphDef()
+            graph_def.ParseFromString(f.read())
+
+        consts = {}
+        for node in graph_def.node:
+            if node.op == 'Const':
+                consts.setdefault(node.name.split('/')[0], []).append(tf.make_ndarray(node.attr['value'].tensor))
+
+        count = 0
+        miss_count = 0
+        for var in self.cnn_vars:
+            shape = var.get_shape().as_list()
+            values = [v for v in consts.get(var.op.name.split('/')[0], []) if list(v.shape) == shape]
+            if len(values) == 1:
+                var.load(values[0], session)
+                count += 1
+            else:
+                miss_count += 1
+                if not ignore_missing:
+                    raise ValueError("No pretrained value found for the variable %s." %(var.op.name))
+        print("%d variables loaded. %d variables missed." %(count, miss_count))
 
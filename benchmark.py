@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+import resource
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+
+from main import get_parser
+from model import QuestionAnswerer, CONV_FEAT_SHAPES
+from utils.store import *
+from base_model import ImageLoader
+from utils.nn import *
+from episodic_memory import *
+
+def time_steps(sess, fetches, feed_dict, num_steps):
+    """ Get the average time of a step, after a few warm-up steps. """
+    for _ in range(2):
+        sess.run(fetches, feed_dict=feed_dict)
+    start_time = time.time()
+    for _ in range(num_steps):
+        sess.run(fetches, feed_dict=feed_dict)
+    return (time.time() - start_time) / num_steps
+
+def random_questions(args, batch_size, num_words):
+    """ Get a batch of random questions with random lengths. """
+    question_lens = np.random.randint(1, args.max_ques_len+1, batch_size)
+    questions = np.random.randint(1, num_words, [batch_size, args.max_ques_len])
+    questions[np.arange(args.max_ques_len) >= question_lens[:, None]] = 0
+    return questions, question_lens
+
+def bench_loader(args):
+    """ Compare the throughput of the serial full-size image loader with the parallel, reduced-scale one. """
+    img_files = sorted(glob.glob(os.path.join(args.train_image_dir, '*.jpg')))[:args.num_images]
+    batch_size = args.batch_size
+    print("Loading %d images from %s in batches of %d..." %(len(img_files), args.train_image_dir, batch_size))
+
+    loader = ImageLoader(args.mean_file)
+    start_time = time.time()
+    for start in range(0, len(img_files), batch_size):
+        np.array([loader.load_img(f) for f in img_files[start:start+batch_size]], np.float32)
+    print("Serial, full-size decode: %.1f images/sec" %(len(img_files) / (time.time() - start_time)))
+
+    for num_threads in sorted(set([1, args.num_load_threads])):
+        loader = ImageLoader(args.mean_file, num_threads)
+        for start in range(0, len(img_files), batch_size):
+            loader.load_imgs(img_files[start:start+batch_size])
+        print("%d thread(s), reduced-scale decode: %.1f images/sec" %(num_threads, loader.imgs_per_sec()))
+
+def bench_question_encoder(args):
+    """ Compare the question encoder of the model with a per-example slice loop over all the GRU states. """
+    num_words = 10000
+    for batch_size in [int(b) for b in args.bench_batch_sizes.split(',')]:
+        for method in ['slice', 'final_state']:
+            tf.reset_default_graph()
+            start_time = time.time()
+            questions = tf.placeholder(tf.int32, [batch_size, args.max_ques_len])
+            question_lens = tf.placeholder(tf.int32, [batch_size])
+            emb_w = weight('emb_w', [num_words, args.dim_embed])
+            ques_embed = tf.nn.embedding_lookup(emb_w, questions)
+            if method == 'final_state':
+                _, question_enc = tf.nn.dynamic_rnn(rnn_cell(args.dim_hidden, args.rnn_cell), ques_embed, sequence_length=question_lens, dtype=tf.float32)
+            else:
+                all_states, _ = tf.nn.dynamic_rnn(rnn_cell(args.dim_hidden, args.rnn_cell), ques_embed, dtype=tf.float32)
+                question_enc = []
+                for k in range(batch_size):
+                    current_ques_enc = tf.slice(all_states, [k, question_lens[k]-1, 0], [1, 1, args.dim_hidden])
+                    question_enc.append(tf.squeeze(current_ques_enc))
+                question_enc = tf.stack(question_enc)
+            opt_op = tf.train.GradientDescentOptimizer(0.1).minimize(tf.reduce_sum(question_enc))
+            build_time = time.time() - start_time
+            num_nodes = len(tf.get_default_graph().as_graph_def().node)
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                q, q_lens = random_questions(args, batch_size, num_words)
+                step_time = time_steps(sess, opt_op, {questions: q, question_lens: q_lens}, args.num_steps)
+
+            print("batch_size=%d %s: build=%.2fs nodes=%d step=%.1fms" %(batch_size, method, build_time, num_nodes, step_time*1000))
+
+def run_attention(args, unroll):
+    """ Build and run the episodic memory with the attention-based GRU, and report its cost. """
+    num_facts, dim_hidden, batch_size = 196, args.dim_hidden, args.batch_size
+    start_time = time.time()
+    facts = tf.placeholder(tf.float32, [None, num_facts, dim_hidden])
+    question = tf.placeholder(tf.float32, [None, dim_hidden])
+    is_train = tf.placeholder(tf.bool)
+    with tf.variable_scope('EpisodicMemory'):
+        episode = EpisodicMemory(dim_hidden, num_facts, question, facts, 'gru', is_train, False, unroll)
+        memory = question
+        for t in range(args.memory_step):
+            with tf.variable_scope('Layer%d' %t):
+                fact, _ = episode.new_fact(memory)
+                memory = tf.contrib.rnn.GRUCell(dim_hidden)(fact, memory)[0]
+    opt_op = tf.train.GradientDescentOptimizer(0.1).minimize(tf.reduce_sum(memory))
+    build_time = time.time() - start_time
+    num_nodes = len(tf.get_default_graph().as_graph_def().node)
+    meta_graph_size = len(tf.train.export_meta_graph().SerializeToString())
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        feed_dict = {facts: np.random.randn(batch_size, num_facts, dim_hidden), question: np.random.randn(batch_size, dim_hidden), is_train: True}
+        step_time = time_steps(sess, opt_op, feed_dict, args.num_steps)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    print("%s: build=%.2fs nodes=%d meta_graph=%.1fMB step=%.1fms peak_rss=%.0fMB" %('unrolled' if unroll else 'loop', build_time, num_nodes, meta_graph_size/1e6, step_time*1000, peak_rss))
+
+def bench_attention(args):
+    """ Compare the unrolled attention-based GRU with the looped one, each in its own process. """
+    for unroll in [True, False]:
+        p = multiprocessing.Process(target=run_attention, args=(args, unroll))
+        p.start()
+        p.join()
+
+def bench_input_fusion(args):
+    """ Compare the CPU step time of the question encoder and the input fusion with each GRU cell and inter-op thread count. """
+    num_words, num_facts, dim_fact, batch_size = 10000, 196, 512, args.batch_size
+    for cell_type in ['gru', 'gru_block']:
+        for inter_op_threads in [1, args.inter_op_threads]:
+            tf.reset_default_graph()
+            with tf.device('/cpu:0'):
+                facts = tf.placeholder(tf.float32, [None, num_facts, dim_fact])
+                questions = tf.placeholder(tf.int32, [None, None])
+                question_lens = tf.placeholder(tf.int32, [None])
+                emb_w = weight('emb_w', [num_words, args.dim_embed])
+                with tf.variable_scope('Question'):
+                    ques_embed = tf.nn.embedding_lookup(emb_w, questions)
+                    _, question_enc = tf.nn.dynamic_rnn(rnn_cell(args.dim_hidden, cell_type), ques_embed, sequence_length=question_lens, dtype=tf.float32)
+                with tf.variable_scope('InputFusion'):
+                    facts_enc = bidirectional_rnn(facts, args.dim_hidden, cell_type)
+                loss = tf.reduce_sum(question_enc) + tf.reduce_sum(facts_enc)
+                opt_op = tf.train.GradientDescentOptimizer(0.1).minimize(loss)
+
+            config = tf.ConfigProto(inter_op_parallelism_threads = inter_op_threads)
+            with tf.Session(config=config) as sess:
+                sess.run(tf.global_variables_initializer())
+                q, q_lens = random_questions(args, batch_size, num_words)
+                feed_dict = {facts: np.random.randn(batch_size, num_facts, dim_fact), questions: q, question_lens: q_lens}
+                step_time = time_steps(sess, opt_op, feed_dict, args.num_steps)
+
+            print("%s, inter_op_threads=%d: step=%.1fms" %(cell_type, inter_op_threads, step_time*1000))
+
+def run_frozen_cnn(args, exclude_cnn):
+    """ Build the training model with a frozen CNN, and report its peak memory and checkpoint size. """
+    args.train_cnn = False
+    model = QuestionAnswerer(args, 'train')
+    saver = model.saver
+    if not exclude_cnn:
+        solver = tf.train.AdamOptimizer(args.learning_rate)
+        trainable_names = set(v.name for v in tf.trainable_variables())
+        solver.apply_gradients([(tf.zeros_like(v), v) for v in model.cnn_vars if v.name in trainable_names])
+        saver = tf.train.Saver(max_to_keep=1)
+
+    save_dir = tempfile.mkdtemp()
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        start_time = time.time()
+        saver.save(sess, os.path.join(save_dir, 'model'))
+        save_time = time.time() - start_time
+    checkpoint_size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(save_dir, 'model*')))
+    shutil.rmtree(save_dir)
+
+    print("%s: variables=%d peak_rss=%.0fMB checkpoint=%.1fMB save=%.2fs" %('CNN excluded' if exclude_cnn else 'CNN included', len(tf.global_variables()), peak_rss, checkpoint_size/1e6, save_time))
+
+def bench_frozen_cnn(args):
+    """ Compare the memory and the checkpoint size of a frozen CNN kept in and left out of the optimizer and the checkpoints. """
+    for exclude_cnn in [False, True]:
+        p = multiprocessing.Process(target=run_frozen_cnn, args=(args, exclude_cnn))
+        p.start()
+        p.join()
+
+def bench_feat_store(args):
+    """ Compare the size, read throughput and fidelity of the feature cache as float32, as float16, and projected with PCA. """
+    num_facts, dim_fact = CONV_FEAT_SHAPES[args.cnn_model]
+    source = FeatureStore(args.feat_cache_dir, 'train_'+args.cnn_model, num_facts, dim_fact)
+    if not source.exists():
+        print("Error: No cached CNN features found in %s. Please extract them first with --use_feat_cache." %(args.feat_cache_dir))
+        return
+    source.load()
+    num_images = min(args.num_images, len(source.image_ids))
+    image_ids, img_files = source.image_ids[:num_images], source.img_files[:num_images]
+    feats = source.get(image_ids)
+
+    pca_dim = args.pca_dim if args.pca_dim > 0 else dim_fact // 4
+    projection = FactProjection(tempfile.gettempdir(), 'bench', pca_dim)
+    projection.accumulate(feats)
+    projection.fit()
+
+    store_dir = tempfile.mkdtemp()
+    for dtype, projected in [(np.float32, False), (np.float16, False), (np.float32, True), (np.float16, True)]:
+        setting_feats = projection.project(feats) if projected else feats
+        store = FeatureStore(store_dir, 'bench', num_facts, setting_feats.shape[-1], dtype)
+        store.create(image_ids, img_files)
+        store.write(0, setting_feats)
+        store.finish()
+        store.load()
+
+        # Relative error of the features rebuilt from the store
+        rebuilt = store.get(image_ids)
+        if projected:
+            rebuilt = rebuilt.dot(projection.components) + projection.mean
+        error = np.linalg.norm(rebuilt - feats) / np.linalg.norm(feats)
+        start_time = time.time()
+        for _ in range(args.num_steps):
+            store.get(np.sort(np.random.choice(image_ids, args.batch_size, replace=False)))
+        imgs_per_sec = args.num_steps * args.batch_size / (time.time() - start_time)
+
+        name = '%s%s' %(np.dtype(dtype).name, ', pca%d' %(pca_dim) if projected else '')
+        print("%s: %.0fKB/image error=%.4f read=%.0f images/sec" %(name, store.data[0].nbytes/1024.0, error, imgs_per_sec))
+    shutil.rmtree(store_dir)
+
+def main(argv):
+    parser = get_parser()
+    parser.add_argument('--bench', default='loader', help='Benchmark to run: Can be loader, question_encoder, attention, input_fusion, frozen_cnn or feat_store')
+    parser.add_argument('--num_images', type=int, default=1000, help='Number of images to use in the benchmark')
+    parser.add_argument('--num_steps', type=int, default=20, help='Number of timed steps per setting')
+    parser.add_argument('--bench_batch_sizes', default='64,128,256,512,1024', help='Comma-separated batch sizes to benchmark')
+    args = parser.parse_args()
+
+    if args.bench == 'loader':
+        bench_loader(args)
+    elif args.bench == 'question_encoder':
+        bench_question_encoder(args)
+    elif args.bench == 'attention':
+        bench_attention(args)
+    elif args.bench == 'input_fusion':
+        bench_input_fusion(args)
+    elif args.bench == 'frozen_cnn':
+        bench_frozen_cnn(args)
+    elif args.bench == 'feat_store':
+        bench_feat_store(args)
+    else:
+        print("Error: Unknown benchmark %s." %(args.bench))
+
+if __name__=="__main__":
+     main(sys.argv)
@@ -1,17 +1,22 @@
 import os
+import json
+import hashlib
 import math
 import numpy as np
 import pandas as pd
 import six.moves.cPickle as pickle
 import skimage
 import skimage.io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.words import *
 from utils.vqa.vqa import *
 
 class DataSet():
-    def __init__(self, img_files, questions, question_lens, question_ids, answers=None, batch_size=1, is_train=False,  shuffle=False):
+    def __init__(self, img_files, image_ids, questions, question_lens, question_ids, answers=None, batch_size=1, is_train=False,  shuffle=False, group_by_image=False, bucket_by_len=False):
         self.img_files = np.array(img_files)
+        self.image_ids = np.array(image_ids)
         self.questions = np.array(questions)
         self.question_lens = np.array(question_lens)
         self.question_ids = np.array(question_ids)
@@ -19,21 +24,50 @@ class DataSet():
         self.batch_size = batch_size
         self.is_train = is_train
         self.shuffle = shuffle
+        self.group_by_image = group_by_image
+        self.bucket_by_len = bucket_by_len and not group_by_image
         self.setup()
 
     def setup(self):
         """ Setup the dataset. """
         self.count = len(self.question_ids)
-        self.num_batches = int(self.count * 1.0 / self.batch_size)
+        self.num_batches = int(math.ceil(self.count * 1.0 / self.batch_size))
         self.current_index = 0
         self.indices = list(range(self.count))
+        if self.group_by_image:
+            self.setup_image_groups()
+        if self.bucket_by_len:
+            self.setup_len_buckets()
         self.reset()
 
+    def setup_image_groups(self):
+        """ Group the questions by their images, so that the questions about the same image fall into the same batches. """
+        _, img_idxs = np.unique(self.image_ids, return_inverse=True)
+        order = np.argsort(img_idxs, kind='mergesort')
+        bounds = np.cumsum(np.bincount(img_idxs))[:-1]
+        self.image_groups = np.split(order, bounds)
+        self.indices = list(order)
+
+    def setup_len_buckets(self):
+        """ Sort the questions by their lengths (breaking ties randomly), so that each batch holds questions of similar lengths. """
+        perm = np.random.permutation(self.count)
+        order = perm[np.argsort(self.question_lens[perm], kind='mergesort')]
+        self.len_buckets = [order[i:i+self.batch_size] for i in range(0, self.count, self.batch_size)]
+        self.indices = list(order)
+
     def reset(self):
         """ Reset the dataset. """
         self.current_index = 0
         if self.shuffle:
-            np.random.shuffle(self.indices)
+            if self.bucket_by_len:
+                self.setup_len_buckets()
+                np.random.shuffle(self.len_buckets)
+                self.indices = list(np.concatenate(self.len_buckets))
+            elif self.group_by_image:
+                np.random.shuffle(self.image_groups)
+                self.indices = list(np.concatenate(self.image_groups))
+            else:
+                np.random.shuffle(self.indices)
 
     def next_batch(self):
         """ Fetch the next batch. """
@@ -42,19 +76,57 @@ class DataSet():
         current_idx = self.indices[start:end]
 
         img_files = self.img_files[current_idx]
+        image_ids = self.image_ids[current_idx]
         questions = self.questions[current_idx]
         question_lens = self.question_lens[current_idx]
         if self.is_train: 
             answers = self.answers[current_idx]
             self.current_index += self.batch_size
-            return img_files, questions, question_lens, answers
+            return img_files, image_ids, questions, question_lens, answers
         else:
             self.current_index += self.batch_size
-            return img_files, questions, question_lens
+            return img_files, image_ids, questions, question_lens
 
     def has_next_batch(self):
-        """ Determine whether there is any batch left. """
-        return self.current_index + self.batch_size <= self.count
+        """ Determine whether there is any batch left (the last one may be partial). """
+        return self.current_index < self.count
+
+
+class BatchPrefetcher():
+    """ Prepare the next batches of a dataset in background threads while the current one is being used. """
+    def __init__(self, dataset, prepare_fn, num_batches, queue_size=2, num_threads=2):
+        self.dataset = dataset
+        self.prepare_fn = prepare_fn
+        self.num_left = num_batches
+        self.queue_size = queue_size
+        self.queue = deque()
+        self.pool = ThreadPoolExecutor(num_threads) if queue_size > 0 else None
+        self.fill()
+
+    def fill(self):
+        """ Submit batches until the queue is full. """
+        # The batches are drawn in order by the calling thread, only their preparation runs in the background
+        while self.pool is not None and len(self.queue) < self.queue_size and self.num_left > 0:
+            batch = self.dataset.next_batch()
+            self.queue.append(self.pool.submit(self.prepare_fn, batch))
+            self.num_left -= 1
+
+    def next_batch(self):
+        """ Fetch the next prepared batch. """
+        if self.pool is None:
+            self.num_left -= 1
+            return self.prepare_fn(self.dataset.next_batch())
+        future = self.queue.popleft()
+        self.fill()
+        return future.result()
+
+    def close(self):
+        """ Drop the pending batches and stop the background threads. """
+        for future in self.queue:
+            future.cancel()
+        self.queue.clear()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
 
 
 def prepare_train_data(args):
@@ -62,15 +134,14 @@ def prepare_train_data(args):
     image_dir, question_file, answer_file, annotation_file = args.train_image_dir, args.train_question_file, args.train_answer_file, args.train_annotation_file
 
     word_table_file, init_embed_with_glove, glove_dir = args.word_table_file, args.init_embed_with_glove, args.glove_dir
+    answer_table_file, max_answers = args.answer_table_file, args.max_answers
     dim_embed, batch_size, max_ques_len = args.dim_embed, args.batch_size, args.max_ques_len
+    group_by_image, bucket_by_len = args.group_by_image, args.bucket_by_len
 
-    vqa = VQA(answer_file, question_file)
-    vqa.filter_by_ques_len(max_ques_len)
-    vqa.filter_by_ans_len(1)
-
-    annotations = process_vqa(vqa, 'COCO_train2014', image_dir, annotation_file)
+    vqa, annotations = load_vqa_split('COCO_train2014', image_dir, question_file, answer_file, annotation_file, max_ques_len, False)
 
     image_files = annotations['image_file'].values
+    image_ids = annotations['image_id'].values
     questions = annotations['question'].values
     question_ids = annotations['question_id'].values
     answers = annotations['answer'].values
@@ -78,25 +149,38 @@ def prepare_train_data(args):
 
     print("Building the word table...")
     word_table = WordTable(dim_embed, max_ques_len, word_table_file)
-    if not os.path.exists(word_table_file):
-        if init_embed_with_glove:
-            word_table.load_glove(glove_dir)
+    if not word_table.exists():
         for ques in questions:
             word_table.add_words(ques.split(' '))
-        for ans in answers:
-            word_table.add_words(ans.split(' '))
         word_table.filter_word2vec()
+        if init_embed_with_glove:
+            word_table.load_glove(glove_dir)
         word_table.compute_freq()
         word_table.save()
     else:
         word_table.load()
     print("Word table built. Number of words = %d." %(word_table.num_words))
 
-    questions, question_lens = symbolize_questions(questions, word_table)
-    answers = symbolize_answers(answers, word_table)
+    print("Building the answer table...")
+    answer_table = AnswerTable(max_answers, answer_table_file)
+    if not answer_table.exists():
+        answer_table.build(answers)
+        answer_table.save()
+    else:
+        answer_table.load()
+    print("Answer table built. Number of answers = %d." %(answer_table.num_answers))
+
+    questions, question_lens = symbolize_questions(questions, word_table, 'train')
+    answers = symbolize_answers(answers, answer_table)
+
+    # Only the questions whose answers are in the answer table can be learned
+    keep = answers >= 0
+    image_files, image_ids, question_ids = image_files[keep], image_ids[keep], question_ids[keep]
+    questions, question_lens, answers = questions[keep], question_lens[keep], answers[keep]
+    print("Number of training questions with a known answer = %d" %(len(question_ids)))
 
     print("Building the training dataset...")
-    dataset = DataSet(image_files, questions, question_lens, question_ids, answers, batch_size, True, True)
+    dataset = DataSet(image_files, image_ids, questions, question_lens, question_ids, answers, batch_size, True, True, group_by_image, bucket_by_len)
     print("Dataset built.")
     return vqa, dataset
 
@@ -107,13 +191,11 @@ def prepare_val_data(args):
     word_table_file, glove_dir = args.word_table_file, args.glove_dir
     dim_embed, batch_size, max_ques_len = args.dim_embed, args.batch_size, args.max_ques_len
 
-    vqa = VQA(answer_file, question_file)
-    vqa.filter_by_ques_len(max_ques_len)
-    vqa.filter_by_ans_len(1)
-
-    annotations = process_vqa(vqa, 'COCO_val2014', image_dir, annotation_file)
+    # The evaluation needs the ground truth answers, which the cache of this split keeps as well
+    vqa, annotations = load_vqa_split('COCO_val2014', image_dir, question_file, answer_file, annotation_file, max_ques_len, True)
 
     image_files = annotations['image_file'].values
+    image_ids = annotations['image_id'].values
     questions = annotations['question'].values
     question_ids = annotations['question_id'].values
     print("Number of validation questions = %d" %(len(question_ids)))
@@ -121,10 +203,10 @@ def prepare_val_data(args):
     word_table = WordTable(dim_embed, max_ques_len, word_table_file)
     word_table.load()
 
-    questions, question_lens = symbolize_questions(questions, word_table)
+    questions, question_lens = symbolize_questions(questions, word_table, 'val')
    
     print("Building the validation dataset...")
-    dataset = DataSet(image_files, questions, question_lens, question_ids)
+    dataset = DataSet(image_files, image_ids, questions, question_lens, question_ids, batch_size=args.eval_batch_size)
     print("Dataset built.")
     return vqa, dataset
 
@@ -141,12 +223,14 @@ def prepare_test_data(args):
 
     images = annotations['image'].unique()
     image_files = [os.path.join(image_dir, f) for f in images]
+    image_ids = list(range(len(images)))
     
-    temp = pd.DataFrame({'image': images, 'image_file': image_files})
+    temp = pd.DataFrame({'image': images, 'image_file': image_files, 'image_id': image_ids})
     annotations = pd.merge(annotations, temp)
     annotations.to_csv(info_file)
 
     image_files = annotations['image_file'].values
+    image_ids = annotations['image_id'].values
     questions = annotations['question'].values
     question_ids = annotations['question_id'].values
     print("Number of testing questions = %d" %(len(question_ids)))
@@ -154,40 +238,129 @@ def prepare_test_data(args):
     word_table = WordTable(dim_embed, max_ques_len, word_table_file)
     word_table.load()
 
-    questions, question_lens = symbolize_questions(questions, word_table)
+    questions, question_lens = symbolize_questions(questions, word_table, 'test')
 
     print("Building the testing dataset...")    
-    dataset = DataSet(image_files, questions, question_lens, question_ids)
+    dataset = DataSet(image_files, image_ids, questions, question_lens, question_ids, batch_size=args.eval_batch_size)
     print("Dataset built.")
     return dataset
 
 
+def load_vqa_split(label, img_dir, question_file, answer_file, annotation_file, max_ques_len, need_vqa):
+    """ Load and process a VQA split, or its cached version if still up to date. """
+    cache_file = os.path.splitext(annotation_file)[0] + '.npz'
+    cache_key = get_vqa_cache_key(question_file, answer_file, max_ques_len, 1)
+
+    vqa, annotations = load_vqa_cache(cache_file, cache_key, label, img_dir, need_vqa)
+    if annotations is not None:
+        return vqa, annotations
+
+    vqa = VQA(answer_file, question_file, max_ques_len, 1)
+
+    annotations = process_vqa(vqa, label, img_dir, annotation_file)
+    save_vqa_cache(cache_file, cache_key, annotations, vqa if need_vqa else None)
+    return vqa, annotations
+
+
+def get_vqa_cache_key(question_file, answer_file, max_ques_len, max_ans_len):
+    """ Identify the source files (by path, size and modification time) and the filters of a processed VQA split. """
+    files = []
+    for f in [question_file, answer_file]:
+        stat = os.stat(f)
+        files.append([os.path.abspath(f), stat.st_size, int(stat.st_mtime)])
+    return json.dumps({'files': files, 'max_ques_len': max_ques_len, 'max_ans_len': max_ans_len}, sort_keys=True)
+
+
+def load_vqa_cache(cache_file, cache_key, label, img_dir, need_vqa):
+    """ Load a processed VQA split (with its ground truth if needed) from its binary cache, if it is up to date. """
+    if not os.path.exists(cache_file):
+        return None, None
+    data = np.load(cache_file)
+    if str(data['key']) != cache_key or (need_vqa and 'gt_answers' not in data.files):
+        print("The cached VQA split in %s is stale." %(cache_file))
+        return None, None
+
+    print("Loading the cached VQA split from %s..." %(cache_file))
+    annotations = build_annotations(data['question_ids'], data['image_ids'], data['questions'], data['answers'], label, img_dir)
+    vqa = build_eval_vqa(data['question_ids'], data['gt_vocab'], data['gt_answers'], data['gt_answer_lens'], data['question_types'], data['answer_types']) if need_vqa else None
+    return vqa, annotations
+
+
+def save_vqa_cache(cache_file, cache_key, annotations, vqa=None):
+    """ Save a processed VQA split (with its ground truth if vqa is given) to its binary cache. """
+    arrays = {'key': np.array(cache_key),
+              'question_ids': annotations['question_id'].values.astype(np.int64),
+              'image_ids': annotations['image_id'].values.astype(np.int64),
+              'questions': annotations['question'].values.astype(np.unicode_),
+              'answers': annotations['answer'].values.astype(np.unicode_)}
+
+    if vqa is not None:
+        anns = [vqa.qa[k] for k in annotations['question_id'].values]
+        gt_vocab = {}
+        gt_answers = [gt_vocab.setdefault(ans['answer'], len(gt_vocab)) for ann in anns for ans in ann['answers']]
+        arrays['gt_vocab'] = np.array(sorted(gt_vocab, key=gt_vocab.get), np.unicode_)
+        arrays['gt_answers'] = np.array(gt_answers, np.int32)
+        arrays['gt_answer_lens'] = np.array([len(ann['answers']) for ann in anns], np.int32)
+        arrays['question_types'] = np.array([ann['question_type'] for ann in anns], np.unicode_)
+        arrays['answer_types'] = np.array([ann['answer_type'] for ann in anns], np.unicode_)
+
+    np.savez(cache_file, **arrays)
+
+
+def build_eval_vqa(question_ids, gt_vocab, gt_answers, gt_answer_lens, question_types, answer_types):
+    """ Build a VQA split holding only the ground truth needed by its evaluation. """
+    gt_vocab = gt_vocab.tolist()
+    starts = np.concatenate([[0], np.cumsum(gt_answer_lens)])
+    anns = []
+    for k, question_id in enumerate(question_ids.tolist()):
+        anns.append({'question_id': question_id,
+                     'question_type': str(question_types[k]),
+                     'answer_type': str(answer_types[k]),
+                     'answers': [{'answer': gt_vocab[i]} for i in gt_answers[starts[k]:starts[k+1]]]})
+
+    vqa = VQA()
+    vqa.dataset = {'annotations': anns}
+    vqa.qa = {ann['question_id']: ann for ann in anns}
+    return vqa
+
+
+def build_annotations(question_ids, image_ids, questions, answers, label, img_dir):
+    """ Build the annotations of a VQA split. """
+    image_files = [os.path.join(img_dir, label+"_000000"+("%06d" %k)+".jpg") for k in image_ids]
+    return pd.DataFrame({'question_id': question_ids, 'image_id': image_ids, 'image_file': image_files, 'question': questions, 'answer': answers})
+
+
 def process_vqa(vqa, label, img_dir, annotation_file):
     """ Build an annotation file containing the training or validation information. """
     question_ids = list(vqa.qa.keys())
     image_ids = [vqa.qa[k]['image_id'] for k in question_ids]
-    image_files = [os.path.join(img_dir, label+"_000000"+("%06d" %k)+".jpg") for k in image_ids]
     answers = [vqa.qa[k]['best_answer'] for k in question_ids]
     questions = [vqa.qqa[k]['question'] for k in question_ids]
 
-    annotations = pd.DataFrame({'question_id': question_ids, 'image_id': image_ids, 'image_file': image_files, 'question': questions, 'answer': answers})
+    annotations = build_annotations(question_ids, image_ids, questions, answers, label, img_dir)
     annotations.to_csv(annotation_file)
     return annotations
 
 
-def symbolize_questions(questions, word_table):
-    """ Translate the questions into the indicies of their words in the vocabulary, and get their lengths. """
-    ques_idxs = []
-    ques_lens = []
-    for q in questions:
-        q_idx, q_len = word_table.symbolize_sent(q)
-        ques_idxs.append(q_idx)
-        ques_lens.append(q_len)
-    return np.array(ques_idxs), np.array(ques_lens)
+def symbolize_questions(questions, word_table, name):
+    """ Translate the questions into the indicies of their words in the vocabulary, and get their lengths (cached). """
+    cache_file = os.path.splitext(word_table.save_file)[0] + '_' + name + '_questions.npz'
+    digest = hashlib.md5('\n'.join(questions).encode('utf-8')).hexdigest()
+    cache_key = '%s_%s_%d' %(word_table.digest(), digest, word_table.max_sent_len)
+
+    if os.path.exists(cache_file):
+        data = np.load(cache_file)
+        if str(data['key']) == cache_key:
+            print("Loading the symbolized questions from %s..." %(cache_file))
+            return data['questions'], data['question_lens']
+
+    ques_idxs, ques_lens = word_table.symbolize_sents(questions)
+    np.savez(cache_file, key=np.array(cache_key), questions=ques_idxs, question_lens=ques_lens)
+    return ques_idxs, ques_lens
 
 
-def symbolize_answers(answers, word_table):
-    """ Translate the answers into their indicies in the vocabulary. """
-    ans_indices = [word_table.word_to_index(ans.split(' ')[0]) for ans in answers]
-    return np.array(ans_indices)
+def symbolize_answers(answers, answer_table):
+    """ Translate the answers into their indicies in the answer vocabulary (-1 for the unknown ones). """
+    ans_indices = [answer_table.answer_to_index(ans) for ans in answers]
+    return np.array(ans_indices, np.int32)
 
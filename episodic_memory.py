@@ -19,10 +19,29 @@ class AttnGRU:
             new_state = attention * c + (1 - attention) * state
         return new_state
 
+    def get_weights(self, input_dim):
+        """ Get the weights of the cell (the same variables as __call__ uses), so that they can be created outside a loop. """
+        with tf.variable_scope('AttnGRU'):
+            with tf.variable_scope('AttnGRU_fc1'):
+                w1 = weight('weights', [input_dim+self.num_units, self.num_units], group_id=1)
+                b1 = bias('biases', [self.num_units], 1.0)
+            with tf.variable_scope('AttnGRU_fc2'):
+                w2 = weight('weights', [input_dim+self.num_units, self.num_units], group_id=1)
+                b2 = bias('biases', [self.num_units], 0.0)
+        return w1, b1, w2, b2
+
+    def step(self, inputs, state, attention, weights):
+        """ Run the cell for one step with the given weights (without batch normalization). """
+        w1, b1, w2, b2 = weights
+        r = tf.sigmoid(tf.nn.xw_plus_b(tf.concat([inputs, state], 1), w1, b1))
+        c = tf.tanh(tf.nn.xw_plus_b(tf.concat([inputs, r*state], 1), w2, b2))
+        new_state = attention * c + (1 - attention) * state
+        return new_state
+
 
 class EpisodicMemory:
     """ Episodic Memory Module. """
-    def __init__(self, num_units, num_facts, question, facts, attention, is_train, bn):
+    def __init__(self, num_units, num_facts, question, facts, attention, is_train, bn, unroll=False):
         self.num_units = num_units                       
         self.num_facts = num_facts                           
         self.question = question                         
@@ -30,36 +49,71 @@ class EpisodicMemory:
         self.attention = attention
         self.is_train = is_train
         self.bn = bn
+        self.unroll = unroll or bn
         self.attn_gru = AttnGRU(num_units, is_train, bn)
 
+        # The question does not change across memory steps
+        q = tf.expand_dims(question, 1)
+        self.cq = facts * q
+        self.dq = tf.abs(facts - q)
+        self.question_cache = {}
+
     def new_fact(self, memory):
         """ Get the context vector by using soft attention or attention-based GRU. """
-        fact_list = tf.unstack(self.facts, axis=1)  
-        mixed_fact = tf.zeros_like(fact_list[0])       
-
         atts = self.attend(memory)                       
 
         if self.attention=='gru':
             with tf.variable_scope('AttnGate') as scope:
-                atts = tf.unstack(atts, axis=1)                                           
-                for ctx, att in zip(fact_list, atts):
-                    mixed_fact = self.attn_gru(ctx, mixed_fact, tf.expand_dims(att, 1))    
-                    scope.reuse_variables()
+                if self.unroll:
+                    mixed_fact = self.unrolled_attn_gru(atts, scope)
+                else:
+                    mixed_fact = self.looped_attn_gru(atts)
         else:
             mixed_fact = tf.reduce_sum(self.facts * tf.expand_dims(atts, 2), 1)        
                
         return mixed_fact, atts                                                                
 
+    def unrolled_attn_gru(self, atts, scope):
+        """ Run the attention-based GRU over the facts, with one cell per fact in the graph. """
+        fact_list = tf.unstack(self.facts, axis=1)  
+        mixed_fact = tf.zeros_like(fact_list[0])       
+        atts = tf.unstack(atts, axis=1)                                           
+        for ctx, att in zip(fact_list, atts):
+            mixed_fact = self.attn_gru(ctx, mixed_fact, tf.expand_dims(att, 1))    
+            scope.reuse_variables()
+        return mixed_fact
+
+    def looped_attn_gru(self, atts):
+        """ Run the attention-based GRU over the facts in a while loop. """
+        weights = self.attn_gru.get_weights(self.facts.get_shape().as_list()[-1])
+        # The unrolled GRU counts the weight decay of its weights once per fact. Keep the same loss
+        for w in weights[0::2]:
+            tf.add_to_collection('l2_1', (self.num_facts-1) * tf.nn.l2_loss(w))
+
+        fact_array = tf.TensorArray(tf.float32, self.num_facts).unstack(tf.transpose(self.facts, [1, 0, 2]))
+        att_array = tf.TensorArray(tf.float32, self.num_facts).unstack(tf.transpose(atts))
+
+        def step(t, state):
+            att = tf.expand_dims(att_array.read(t), 1)
+            return t + 1, self.attn_gru.step(fact_array.read(t), state, att, weights)
+
+        initial_state = tf.zeros_like(self.facts[:, 0, :])
+        _, mixed_fact = tf.while_loop(lambda t, _: t < self.num_facts, step, [tf.constant(0), initial_state])
+        return mixed_fact
+
     def attend(self, memory):
         """ Get the attention weights. """
         c = self.facts                                                                
-        q = tf.tile(tf.expand_dims(self.question, 1), [1, self.num_facts, 1])              
-        m = tf.tile(tf.expand_dims(memory, 1), [1, self.num_facts, 1])                     
+        m = tf.expand_dims(memory, 1)                                                     
 
-        z = tf.concat([c * q, c * m, tf.abs(c - q), tf.abs(c - m)], 2)                   
-        z = tf.reshape(z, [-1, 4 * self.num_units])                                      
+        # Same as a fully-connected layer on [c*q, c*m, |c-q|, |c-m|], but the blocks are broadcast instead of tiled and concatenated
+        with tf.variable_scope('EM_att_fc1'):
+            w = weight('weights', [4 * self.num_units, self.num_units], group_id=1)
+            b = bias('biases', [self.num_units])
+        w_cq, w_cm, w_dq, w_dm = tf.split(w, 4, 0)
 
-        z1 = fully_connected(z, self.num_units, 'EM_att_fc1', group_id=1)  
+        z1 = self.question_terms(w_cq, w_dq, b) + self.project(c * m, w_cm) + self.project(tf.abs(c - m), w_dm)
+        z1 = tf.reshape(z1, [-1, self.num_units])                                        
         z1 = batch_norm(z1, 'EM_att_bn1', self.is_train, self.bn, 'tanh')
 
         z2 = fully_connected(z1, 1, 'EM_att_fc2', group_id=1)
@@ -69,3 +123,14 @@ class EpisodicMemory:
         atts = tf.nn.softmax(z2)                                                          
         return atts
 
+    def question_terms(self, w_cq, w_dq, b):
+        """ Get the part of the attention layer which only depends on the question, once per set of weights. """
+        scope_name = tf.get_variable_scope().name
+        if scope_name not in self.question_cache:
+            self.question_cache[scope_name] = self.project(self.cq, w_cq) + self.project(self.dq, w_dq) + b
+        return self.question_cache[scope_name]
+
+    def project(self, x, w):
+        """ Multiply the [batch, num_facts, num_units] tensor x by the matrix w. """
+        z = tf.matmul(tf.reshape(x, [-1, self.num_units]), w)
+        return tf.reshape(z, [-1, self.num_facts, self.num_units])
@@ -8,17 +8,34 @@ from model import *
 from dataset import *
 from utils.vqa.vqa import *
 
-def main(argv):
+def get_parser():
+    """ Get the parser of the command line arguments. """
     parser = argparse.ArgumentParser()
     
     parser.add_argument('--phase', default='train', help='Phase: Can be train, val or test')
     parser.add_argument('--load', action='store_true', default=False, help='Turn on to load the pretrained model')
 
     parser.add_argument('--mean_file', default='./utils/ilsvrc_2012_mean.npy', help='Dataset image mean: a Numpy array with (Channel, Height, Width) dimensions')
+    parser.add_argument('--num_load_threads', type=int, default=4, help='Number of threads decoding the images of a batch in parallel')
+    parser.add_argument('--prefetch_size', type=int, default=2, help='Number of training batches prepared in the background ahead of the current step. Set to 0 to prepare them in lockstep')
+    parser.add_argument('--num_prefetch_threads', type=int, default=2, help='Number of background threads preparing the training batches')
     parser.add_argument('--cnn_model', default='vgg16', help='CNN model to use: Can be vgg16, resnet50, resnet101 or resnet152')
     parser.add_argument('--cnn_model_file', default='./tfmodels/vgg16.tfmodel', help='Tensorflow model file for the chosen CNN model')
     parser.add_argument('--load_cnn_model', action='store_true', default=False, help='Turn on to load the pretrained CNN model')
     parser.add_argument('--train_cnn', action='store_true', default=False, help='Turn on to jointly train CNN and RNN. Otherwise, only RNN is trained')
+    parser.add_argument('--use_feat_cache', action='store_true', default=False, help='Turn on to extract the CNN features once and read them from a memory-mapped cache afterwards (only when the CNN is not trained)')
+    parser.add_argument('--feat_cache_dir', default='./feats/', help='Directory to store the cached CNN features')
+    parser.add_argument('--feat_dtype', default='float32', help='Type of the cached CNN features: Can be float32 or float16')
+    parser.add_argument('--pca_dim', type=int, default=0, help='Dimension to project the cached CNN features onto with PCA. 0 keeps them unprojected. Needs --use_feat_cache')
+    parser.add_argument('--pca_sample_size', type=int, default=2000, help='Number of training images to fit the PCA projection on')
+    parser.add_argument('--use_img_store', action='store_true', default=False, help='Turn on to decode, resize and crop the images once and read them from a memory-mapped uint8 store afterwards (unless the feature cache is used)')
+    parser.add_argument('--img_store_dir', default='./imgs/', help='Directory to store the converted images')
+    parser.add_argument('--use_records', action='store_true', default=False, help='Turn on to write the training split once into sharded record files, and train from them through an input pipeline instead of feeding each batch. Cannot be combined with --use_feat_cache')
+    parser.add_argument('--record_dir', default='./records/', help='Directory to store the record files')
+    parser.add_argument('--num_shards', type=int, default=16, help='Number of record files per split')
+    parser.add_argument('--num_readers', type=int, default=4, help='Number of record files read in parallel, and of records parsed in parallel')
+    parser.add_argument('--shuffle_size', type=int, default=10000, help='Number of records in the shuffle buffer of the input pipeline')
+    parser.add_argument('--facts_only', action='store_true', default=False, help='Turn on to skip building the CNN and read the facts from the feature cache only. The cache must have been filled by an earlier run with --use_feat_cache')
   
     parser.add_argument('--train_image_dir', default='./train/images/', help='Directory containing the COCO train2014 images')
     parser.add_argument('--train_question_file', default='./train/OpenEnded_mscoco_train2014_questions.json', help='JSON file storing the open-ended questions for COCO train2014 images')
@@ -30,6 +47,7 @@ def main(argv):
     parser.add_argument('--val_answer_file', default='./val/mscoco_val2014_annotations.json', help='JSON file storing the answers to open-ended questions for COCO val2014 images')
     parser.add_argument('--val_annotation_file', default='./val/anns.csv', help='Temporary file to store the validation information')
     parser.add_argument('--val_result_dir', default='./val/results/', help='Directory to store the validation results as images')
+    parser.add_argument('--num_val_batches', type=int, default=0, help='Number of batches to validate. 0 validates the whole split')
 
     parser.add_argument('--test_image_dir', default='./test/images/', help='Directory containing the testing images')
     parser.add_argument('--test_question_file', default='./test/questions.csv', help='File storing the questions for testing images')
@@ -37,7 +55,9 @@ def main(argv):
     parser.add_argument('--test_result_file', default='./test/results.csv', help='File to store the testing results')
     parser.add_argument('--test_result_dir', default='./test/results/', help='Directory to store the testing results as images')
 
-    parser.add_argument('--word_table_file', default='./words/word_table.pickle', help='Temporary file to store the word table')
+    parser.add_argument('--word_table_file', default='./words/word_table.pickle', help='Temporary file to store the word table. The table is saved next to it as <name>_vecs.npy, <name>_freq.npy and <name>_vocab.txt, and a pickled table from older versions is still read')
+    parser.add_argument('--answer_table_file', default='./words/answer_table.txt', help='Temporary file to store the answer vocabulary of the decoder')
+    parser.add_argument('--max_answers', type=int, default=0, help='Number of most frequent training answers the decoder can predict. 0 keeps all of them. Training questions with other answers are ignored')
     parser.add_argument('--glove_dir', default='./words/', help='Directory containing the GloVe data')
     parser.add_argument('--max_ques_len', type=int, default=30, help='Maximum length of the question. Extremely long questions will be ignored')
 
@@ -47,6 +67,9 @@ def main(argv):
     parser.add_argument('--solver', default='adam', help='Optimizer to use: Can be adam, momentum, rmsprop or sgd') 
     parser.add_argument('--num_epochs', type=int, default=1, help='Number of training epochs')
     parser.add_argument('--batch_size', type=int, default=64, help='Batch size')
+    parser.add_argument('--eval_batch_size', type=int, default=64, help='Batch size for validation and testing')
+    parser.add_argument('--group_by_image', action='store_true', default=False, help='Turn on to put the questions about the same image into the same batch, so that each image is loaded and run through the CNN once per batch')
+    parser.add_argument('--bucket_by_len', action='store_true', default=False, help='Turn on to put questions of similar lengths into the same batch, so that the question encoder unrolls fewer steps. Ignored with --group_by_image')
     parser.add_argument('--learning_rate', type=float, default=1e-3, help='Learning rate')
     parser.add_argument('--weight_decay', type=float, default=5e-4, help='Weight decay')
     parser.add_argument('--momentum', type=float, default=0.9, help='Momentum (for some optimizers)') 
@@ -54,19 +77,28 @@ def main(argv):
     parser.add_argument('--batch_norm', action='store_true', default=False, help='Turn on to use batch normalization')  
 
     parser.add_argument('--dim_hidden', type=int, default=500, help='Dimension of the hidden state in each GRU')
+    parser.add_argument('--rnn_cell', default='gru', help='GRU cell of the question encoder and the input fusion: Can be gru or gru_block (fused kernel). Models trained with one cannot be loaded with the other')
+    parser.add_argument('--inter_op_threads', type=int, default=0, help='Number of threads running independent ops (like the two directions of the input fusion) concurrently. 0 lets Tensorflow decide')
     parser.add_argument('--dim_embed', type=int, default=300, help='Dimension of the word embedding')
     parser.add_argument('--memory_step', type=int, default=3, help='Number of memory update steps')
     parser.add_argument('--memory_update', default='gru', help='Memory update mechanism: Can be gru or mlp')
     parser.add_argument('--attention', default='soft', help='Attention mechanism: Can be soft or gru')
+    parser.add_argument('--unroll_attention', action='store_true', default=False, help='Turn on to unroll the attention-based GRU over the facts in the graph instead of running it in a loop. Always unrolled with batch normalization')
     parser.add_argument('--init_embed_with_glove', action='store_true', default=False, help='Turn on to initialize the word embedding with the GloVe data')  
     parser.add_argument('--fix_embed_weight', action='store_true', default=False, help='Turn on to fix the word embedding')
     parser.add_argument('--save_embed', action='store_true', default=False, help='Turn on to fix the word embedding')
     parser.add_argument('--tie_memory_weight', action='store_true', default=False, help='Turn on to tie the memory weights at different time steps')
-    parser.add_argument('--class_balancing_factor', type=float, default=0.0, help='Class balancing factor. The larger it is, the model pays more attention to rare words.') 
+    parser.add_argument('--class_balancing_factor', type=float, default=0.0, help='Class balancing factor. The larger it is, the model pays more attention to rare answers.') 
+
+    return parser
 
-    args = parser.parse_args()
+def main(argv):
+    args = get_parser().parse_args()
+    if args.phase == 'train' and args.use_records and (args.use_feat_cache or args.facts_only):
+        print("Error: --use_records reads the images from the record files, so it cannot be combined with --use_feat_cache or --facts_only.")
+        sys.exit(0)
 
-    config = tf.ConfigProto(allow_soft_placement = True)
+    config = tf.ConfigProto(allow_soft_placement = True, inter_op_parallelism_threads = args.inter_op_threads)
     #config.gpu_options.per_process_gpu_memory_fraction=0.9
     config.gpu_options.allow_growth = True
     with tf.Session(config=config) as sess:
@@ -80,11 +112,8 @@ def main(argv):
 
             if args.load:
                 model.load(sess)
-            elif args.load_cnn_model:
-                if args.cnn_model == 'vgg16':
-                    model.load2(args.cnn_model_file, sess)
-                else:
-                    model.cnn_saver.restore(sess,args.cnn_model_file) 
+            elif args.load_cnn_model and not args.facts_only:
+                model.load_cnn(sess)
 
             model.train(sess, train_vqa, train_data)
 
@@ -92,6 +121,7 @@ def main(argv):
         elif args.phase == 'val':
             val_vqa, val_data = prepare_val_data(args)
             model = QuestionAnswerer(args, 'val')
+            sess.run(tf.initialize_all_variables())
             model.load(sess)
             model.val(sess, val_vqa, val_data)
 
@@ -99,6 +129,7 @@ def main(argv):
         else:
             test_data = prepare_test_data(args)
             model = QuestionAnswerer(args, 'test')          
+            sess.run(tf.initialize_all_variables())
             model.load(sess)
             model.test(sess, test_data)
 
@@ -8,15 +8,33 @@ from utils.nn import *
 from episodic_memory import *
 from collections import namedtuple
 
+# Shape of the facts (the flattened last convolutional feats) of each CNN
+CONV_FEAT_SHAPES = {'vgg16': [196, 512], 'resnet50': [49, 2048], 'resnet101': [49, 2048], 'resnet152': [49, 2048], 'resnet_cifar10': [49, 2048]}
+
 class QuestionAnswerer(BaseModel):
     def build(self):
         """ Build the model. """
-        self.build_cnn()
+        if self.facts_only:
+            self.build_facts_input()
+        else:
+            self.build_cnn()
         self.build_rnn()
 
+    def build_facts_input(self):
+        """ Declare the shape of the facts of the chosen CNN without building it. """
+        print("Skipping the CNN part (facts only)...")
+        self.conv_feat_shape = CONV_FEAT_SHAPES[self.cnn_model]
+        self.is_train = tf.placeholder(tf.bool)
+        self.cnn_vars = []
+
     def build_cnn(self):
         """ Build the CNN. """
         print("Building the CNN part...")
+        num_vars = len(tf.global_variables())
+
+        # A frozen CNN always runs in inference mode, whatever mode the RNN runs in
+        self.is_train = tf.placeholder(tf.bool)
+        self.cnn_is_train = self.is_train if self.train_cnn else tf.constant(False)
         if self.cnn_model=='vgg16':
             self.build_vgg16()
         elif self.cnn_model=='resnet50':
@@ -27,16 +45,24 @@ class QuestionAnswerer(BaseModel):
             self.build_resnet32_cifar10()
         else:
             self.build_resnet152()
+        self.cnn_vars = tf.global_variables()[num_vars:]
+
+        # Each distinct image of a batch goes through the CNN only once, and its features are shared by all of its questions
+        # (The record files hold one image per question)
+        if self.use_records:
+            self.img_idxs = tf.placeholder_with_default(tf.range(tf.shape(self.imgs)[0]), [None])
+        else:
+            self.img_idxs = tf.placeholder(tf.int32, [None])
         print("CNN part built.")
 
     def build_vgg16(self):
         """ Build the VGG16 net. """
         bn = self.params.batch_norm
 
-        imgs = tf.placeholder(tf.float32, [self.batch_size]+self.img_shape)
-        is_train = tf.placeholder(tf.bool)
+        imgs = self.image_input()
+        is_train = self.cnn_is_train
 
-        conv1_1_feats = convolution(imgs, 3, 3, 64, 1, 1, 'conv1_1')
+        conv1_1_feats = convolution(self.normalize_imgs(imgs), 3, 3, 64, 1, 1, 'conv1_1')
         conv1_1_feats = batch_norm(conv1_1_feats, 'bn1_1', is_train, bn, 'relu')
         conv1_2_feats = convolution(conv1_1_feats, 3, 3, 64, 1, 1, 'conv1_2')
         conv1_2_feats = batch_norm(conv1_2_feats, 'bn1_2', is_train, bn, 'relu')
@@ -72,13 +98,12 @@ class QuestionAnswerer(BaseModel):
         conv5_3_feats = batch_norm(conv5_3_feats, 'bn5_3', is_train, bn, 'relu')
 
         self.permutation = self.get_permutation(14, 14)
-        conv5_3_feats.set_shape([self.batch_size, 14, 14, 512])
+        conv5_3_feats.set_shape([None, 14, 14, 512])
         conv5_3_feats_flat = self.flatten_feats(conv5_3_feats, 512)
         self.conv_feats = conv5_3_feats_flat
         self.conv_feat_shape = [196, 512]
 
         self.imgs = imgs
-        self.is_train = is_train
         self.cnn_saver = tf.train.Saver()
 
     def basic_block(self, input_feats, name1, name2, is_train, bn, c, s=2):
@@ -118,10 +143,10 @@ class QuestionAnswerer(BaseModel):
         """ Build the ResNet50 net. """
         bn = self.params.batch_norm
 
-        imgs = tf.placeholder(tf.float32, [self.batch_size]+self.img_shape)
-        is_train = tf.placeholder(tf.bool)     
+        imgs = self.image_input()
+        is_train = self.cnn_is_train
 
-        conv1_feats = convolution(imgs, 7, 7, 64, 2, 2, 'conv1')
+        conv1_feats = convolution(self.normalize_imgs(imgs), 7, 7, 64, 2, 2, 'conv1')
         conv1_feats = batch_norm(conv1_feats, 'bn_conv1', is_train, bn, 'relu')
         pool1_feats = max_pool(conv1_feats, 3, 3, 2, 2, 'pool1')
 
@@ -146,13 +171,12 @@ class QuestionAnswerer(BaseModel):
         res5c_feats = self.basic_block2(res5b_feats, 'res5c', 'bn5c', is_train, bn, 512)
 
         self.permutation = self.get_permutation(7, 7)
-        res5c_feats.set_shape([self.batch_size, 7, 7, 2048])
+        res5c_feats.set_shape([None, 7, 7, 2048])
         res5c_feats_flat = self.flatten_feats(res5c_feats, 2048)
         self.conv_feats = res5c_feats_flat
         self.conv_feat_shape = [49, 2048]
 
         self.imgs = imgs
-        self.is_train = is_train
         self.cnn_saver = tf.train.Saver()
 
 ######
@@ -248,8 +272,8 @@ class QuestionAnswerer(BaseModel):
                              relu_leakiness=0.1,
                              keep_prob=0.8,
                              )
-        X = tf.placeholder(tf.float32, [self.batch_size]+self.img_shape, name="x")
-        is_training = tf.placeholder(tf.bool, name="is_training")
+        X = self.image_input(name="x")
+        is_training = self.cnn_is_train
         strides=[1, 2, 2]
         filters=[16, 16, 32, 64]
         activate_before_residual = [True, False, False]
@@ -257,7 +281,7 @@ class QuestionAnswerer(BaseModel):
         
         # 3x3 Convolutional Layer with 16 filters and stride of 1
         with tf.variable_scope("init"):
-            x = self.conv2d(X, 3, 3, filters[1], strides[0], "CONV_3X3_S1X16")
+            x = self.conv2d(self.normalize_imgs(X), 3, 3, filters[1], strides[0], "CONV_3X3_S1X16")
             
         x=self.residual_unit (x, filters[0], filters[1], strides[0], "unit_1", is_training,
                   self.hps.relu_leakiness, self.hps.keep_prob, activate_before_residual[0], self.hps.num_residual_units)
@@ -269,14 +293,13 @@ class QuestionAnswerer(BaseModel):
         
         x_int = max_pool(x_int, 2, 2, 2, 2, 'pool_addo')
         self.permutation = self.get_permutation(7, 7)
-        #x_int.set_shape([self.batch_size, 7, 7, 2048])
-        x_int = tf.reshape(x_int, [self.batch_size, 7, 7, 2048])
+        #x_int.set_shape([None, 7, 7, 2048])
+        x_int = tf.reshape(x_int, [-1, 7, 7, 2048])
         x_flat = self.flatten_feats(x_int, 2048)
         self.conv_feats = x_flat
         self.conv_feat_shape = [49, 2048]
 
         self.imgs = X
-        self.is_train = is_training
 
         # Creating a saver instance just for CNN
         
@@ -294,10 +317,10 @@ class QuestionAnswerer(BaseModel):
         """ Build the ResNet101 net. """
         bn = self.params.batch_norm
 
-        imgs = tf.placeholder(tf.float32, [self.batch_size]+self.img_shape)
-        is_train = tf.placeholder(tf.bool)
+        imgs = self.image_input()
+        is_train = self.cnn_is_train
 
-        conv1_feats = convolution(imgs, 7, 7, 64, 2, 2, 'conv1')
+        conv1_feats = convolution(self.normalize_imgs(imgs), 7, 7, 64, 2, 2, 'conv1')
         conv1_feats = batch_norm(conv1_feats, 'bn_conv1', is_train, bn, 'relu')
         pool1_feats = max_pool(conv1_feats, 3, 3, 2, 2, 'pool1')
 
@@ -322,23 +345,22 @@ class QuestionAnswerer(BaseModel):
         res5c_feats = self.basic_block2(res5b_feats, 'res5c', 'bn5c', is_train, bn, 512)
 
         self.permutation = self.get_permutation(7, 7)
-        res5c_feats.set_shape([self.batch_size, 7, 7, 2048])
+        res5c_feats.set_shape([None, 7, 7, 2048])
         res5c_feats_flat = self.flatten_feats(res5c_feats, 2048)
         self.conv_feats = res5c_feats_flat
         self.conv_feat_shape = [49, 2048]
 
         self.imgs = imgs
-        self.is_train = is_train
         self.cnn_saver = tf.train.Saver()
 
     def build_resnet152(self):
         """ Build the ResNet152 net. """
         bn = self.params.batch_norm
 
-        imgs = tf.placeholder(tf.float32, [self.batch_size]+self.img_shape)
-        is_train = tf.placeholder(tf.bool)
+        imgs = self.image_input()
+        is_train = self.cnn_is_train
 
-        conv1_feats = convolution(imgs, 7, 7, 64, 2, 2, 'conv1')
+        conv1_feats = convolution(self.normalize_imgs(imgs), 7, 7, 64, 2, 2, 'conv1')
         conv1_feats = batch_norm(conv1_feats, 'bn_conv1', is_train, bn, 'relu')
         pool1_feats = max_pool(conv1_feats, 3, 3, 2, 2, 'pool1')
 
@@ -363,15 +385,30 @@ class QuestionAnswerer(BaseModel):
         res5c_feats = self.basic_block2(res5b_feats, 'res5c', 'bn5c', is_train, bn, 512)
 
         self.permutation = self.get_permutation(7, 7)
-        res5c_feats.set_shape([self.batch_size, 7, 7, 2048])
+        res5c_feats.set_shape([None, 7, 7, 2048])
         res5c_feats_flat = self.flatten_feats(res5c_feats, 2048)
         self.conv_feats = res5c_feats_flat
         self.conv_feat_shape = [49, 2048]
 
-        self.img_files = img_files
-        self.is_train = is_train
+        self.imgs = imgs
         self.cnn_saver = tf.train.Saver()
 
+    def image_input(self, name=None):
+        """ Get the input of the CNN: A batch of uint8 images, from the record files unless fed. """
+        if self.use_records:
+            return tf.placeholder_with_default(self.record_batch['image'], [None]+self.img_shape, name=name)
+        return tf.placeholder(tf.uint8, [None]+self.img_shape, name=name)
+
+    def rnn_input(self, key, dtype, shape):
+        """ Get an input of the RNN, from the record files unless fed. """
+        if self.use_records:
+            return tf.placeholder_with_default(self.record_batch[key], shape)
+        return tf.placeholder(dtype, shape)
+
+    def normalize_imgs(self, imgs):
+        """ Cast a batch of uint8 images to float and subtract the dataset mean, in the graph. """
+        return tf.cast(imgs, tf.float32) - tf.constant(self.img_loader.mean, tf.float32)
+
     def get_permutation(self, height, width):
         """ Get the permutation corresponding to a snake-like walk as decribed by the paper. Used to flatten the convolutional feats. """
         permutation = np.zeros(height*width, np.int32)
@@ -382,7 +419,7 @@ class QuestionAnswerer(BaseModel):
 
     def flatten_feats(self, feats, channels):
         """ Flatten the feats. """
-        temp1 = tf.reshape(feats, [self.batch_size, -1, channels])
+        temp1 = tf.reshape(feats, [tf.shape(feats)[0], -1, channels])
         temp1 = tf.transpose(temp1, [1, 0, 2])
         temp2 = tf.gather(temp1, self.permutation)
         temp2 = tf.transpose(temp2, [1, 0, 2])
@@ -394,32 +431,37 @@ class QuestionAnswerer(BaseModel):
         params = self.params
         bn = params.batch_norm      
         is_train = self.is_train
-        batch_size = self.batch_size                     
 
         dim_hidden = params.dim_hidden                     
         dim_embed = params.dim_embed                       
         max_ques_len = params.max_ques_len                 
 
-        num_facts = self.conv_feat_shape[0]                                      
-        dim_fact = self.conv_feat_shape[1]                                      
+        num_facts, dim_fact = self.get_fact_shape()
         num_words = self.word_table.num_words              
+        num_answers = self.answer_table.num_answers
 
-        self.word_weight = np.exp(-np.array(self.word_table.word_freq)*self.class_balancing_factor)
+        self.answer_weight = np.exp(-np.array(self.answer_table.ans_freq)*self.class_balancing_factor)
 
-        if not self.train_cnn:
-            facts = tf.placeholder(tf.float32, [batch_size, num_facts, dim_fact])   
+        if self.train_cnn:
+            facts = tf.gather(self.conv_feats, self.img_idxs)
+        elif self.use_records:
+            # The images come with the records, so the frozen CNN runs in the same graph
+            facts = tf.stop_gradient(tf.gather(self.conv_feats, self.img_idxs))
         else:
-            facts = self.conv_feats
+            facts = tf.placeholder(tf.float32, [None, num_facts, dim_fact])   
 
-        questions = tf.placeholder(tf.int32, [batch_size, max_ques_len])        
-        question_lens = tf.placeholder(tf.int32, [batch_size])                   
-        answers = tf.placeholder(tf.int32, [batch_size])                        
-        answer_weights = tf.placeholder(tf.float32, [batch_size])                        
+        questions = self.rnn_input('question', tf.int32, [None, None])        
+        question_lens = self.rnn_input('question_len', tf.int32, [None])                   
+        answers = self.rnn_input('answer', tf.int32, [None])                        
+        if self.use_records:
+            answer_weights = tf.placeholder_with_default(tf.gather(tf.constant(self.answer_weight, tf.float32), answers), [None])
+        else:
+            answer_weights = tf.placeholder(tf.float32, [None])                        
         
-        gru = tf.contrib.rnn.GRUCell(dim_hidden)
+        rnn_cell_type = params.rnn_cell
 
         # Initialize the word embedding
-        idx2vec = np.array([self.word_table.word2vec[self.word_table.idx2word[i]] for i in range(num_words)])
+        idx2vec = self.word_table.word_vecs
         with tf.variable_scope('embedding'):
             if params.fix_embed_weight:
                 emb_w = tf.convert_to_tensor(idx2vec, tf.float32)                       
@@ -428,46 +470,30 @@ class QuestionAnswerer(BaseModel):
 
         # Encode the questions
         with tf.variable_scope('Question'):
-            word_list = tf.unstack(questions, axis=1)                                             
-            ques_embed = [tf.nn.embedding_lookup(emb_w, word) for word in word_list]             
-            ques_embed = tf.transpose(tf.stack(ques_embed), [1, 0, 2])   
-
-            all_states, final_state = tf.nn.dynamic_rnn(gru, ques_embed, dtype=tf.float32)       
-
-            question_enc = []
-            for k in range(batch_size):
-                current_ques_enc = tf.slice(all_states, [k, question_lens[k]-1, 0], [1, 1, dim_hidden]) 
-                question_enc.append(tf.squeeze(current_ques_enc))
+            ques_embed = tf.nn.embedding_lookup(emb_w, questions)                                
 
-            question_enc = tf.stack(question_enc)                                                 
-           #ques_enc = final_state
+            # The GRU stops at the length of each question, so its final state is the state at the last word
+            all_states, final_state = tf.nn.dynamic_rnn(rnn_cell(dim_hidden, rnn_cell_type), ques_embed, sequence_length=question_lens, dtype=tf.float32)       
+            question_enc = final_state                                                            
 
         # Encode the facts
         with tf.name_scope('InputFusion'):
-
-            with tf.variable_scope('Forward'):
-                forward_states, _ = tf.nn.dynamic_rnn(gru, facts, dtype=tf.float32)           
-
-            with tf.variable_scope('Backward'):
-                reversed_facts = tf.reverse(facts, [1])                   
-                backward_states, _ = tf.nn.dynamic_rnn(gru, reversed_facts, dtype=tf.float32) 
-                backward_states = tf.reverse(backward_states, [1])              
-
-            facts_enc = forward_states + backward_states                                      
+            facts_enc = bidirectional_rnn(facts, dim_hidden, rnn_cell_type)                      
 
         # Episodic Memory Update
         with tf.variable_scope('EpisodicMemory'):
-            episode = EpisodicMemory(dim_hidden, num_facts, question_enc, facts_enc, params.attention, is_train, bn)
+            episode = EpisodicMemory(dim_hidden, num_facts, question_enc, facts_enc, params.attention, is_train, bn, params.unroll_attention)
             memory = tf.identity(question_enc)                                                   
             
             # Tied memory weights
             if params.tie_memory_weight: 
+                gru = tf.contrib.rnn.GRUCell(dim_hidden)
                 with tf.variable_scope('Layer') as scope:
                     for t in range(params.memory_step):
+                        fact, attentions = episode.new_fact(memory)
                         if params.memory_update == 'gru': 
-                            memory = gru(episode.new_fact(memory), memory)[0]                     
+                            memory = gru(fact, memory)[0]                     
                         else:
-                            fact = episode.new_fact(memory)                                        
                             expanded_memory = tf.concat([memory, fact, question_enc], 1)           
                             memory = fully_connected(expanded_memory, dim_hidden, 'EM_fc', group_id=1)
                             memory = batch_norm(memory, 'EM_bn', is_train, bn, 'relu')  
@@ -477,10 +503,11 @@ class QuestionAnswerer(BaseModel):
             else:
                 for t in range(params.memory_step):
                     with tf.variable_scope('Layer%d' %t) as scope:
+                        fact, attentions = episode.new_fact(memory)
                         if params.memory_update == 'gru':
-                            memory = gru(episode.new_fact(memory), memory)[0]                     
+                            # Each layer has its own cell, since a cell cannot be used in two variable scopes
+                            memory = tf.contrib.rnn.GRUCell(dim_hidden)(fact, memory)[0]                     
                         else:
-                            fact = episode.new_fact(memory)                                        
                             expanded_memory = tf.concat([memory, fact, question_enc], 1)           
                             memory = fully_connected(expanded_memory, dim_hidden, 'EM_fc', group_id=1)
                             memory = batch_norm(memory, 'EM_bn', is_train, bn, 'relu')  
@@ -490,7 +517,7 @@ class QuestionAnswerer(BaseModel):
         # Compute the result
         with tf.variable_scope('Result'):    
             expanded_memory = tf.concat([memory, question_enc], 1)    
-            logits = fully_connected(expanded_memory, num_words, 'dec', group_id=1)
+            logits = fully_connected(expanded_memory, num_answers, 'dec', group_id=1)
             results = tf.argmax(logits, 1)                                                        
             all_probs = tf.nn.softmax(logits)                                                    
             probs = tf.reduce_max(all_probs, 1)                                                      
@@ -516,7 +543,12 @@ class QuestionAnswerer(BaseModel):
         else:
             solver = tf.train.GradientDescentOptimizer(params.learning_rate)
 
-        tvars = tf.trainable_variables()
+        # A frozen CNN gets no optimizer slots
+        if self.train_cnn:
+            tvars = tf.trainable_variables()
+        else:
+            cnn_var_names = set(v.name for v in self.cnn_vars)
+            tvars = [v for v in tf.trainable_variables() if v.name not in cnn_var_names]
         gs, _ = tf.clip_by_global_norm(tf.gradients(loss, tvars), 3.0)
         opt_op = solver.apply_gradients(zip(gs, tvars), global_step=self.global_step)
 
@@ -533,27 +565,28 @@ class QuestionAnswerer(BaseModel):
 
         self.results = results
         self.probs = probs
+        self.attentions = attentions
         
         print("RNN part built.")        
 
-    def get_feed_dict(self, batch, is_train, feats=None):
+    def get_feed_dict(self, prepared_batch, is_train, feats=None):
         """ Get the feed dictionary for the current batch. """
+        batch, imgs, img_idxs, _, answer_weights = prepared_batch
+        questions, question_lens = batch[2], batch[3]
+        # Cut the padding beyond the longest question of the batch
+        questions = questions[:, :np.max(question_lens)]
         if is_train:
             # training phase
-            img_files, questions, question_lens, answers = batch
-            imgs = self.img_loader.load_imgs(img_files)
-            answer_weights = self.word_weight[answers]
+            answers = batch[4]
             if self.train_cnn:
-                return {self.imgs: imgs, self.questions: questions, self.question_lens: question_lens, self.answers: answers, self.answer_weights: answer_weights, self.is_train: is_train}
+                return {self.imgs: imgs, self.img_idxs: img_idxs, self.questions: questions, self.question_lens: question_lens, self.answers: answers, self.answer_weights: answer_weights, self.is_train: is_train}
             else:
                 return {self.facts: feats, self.questions: questions, self.question_lens: question_lens, self.answers: answers, self.answer_weights: answer_weights, self.is_train: is_train}
 
         else:
             # testing or validation phase
-            img_files, questions, question_lens = batch
-            imgs = self.img_loader.load_imgs(img_files)
             if self.train_cnn: 
-                return {self.imgs: imgs, self.questions: questions, self.question_lens: question_lens, self.is_train: is_train} 
+                return {self.imgs: imgs, self.img_idxs: img_idxs, self.questions: questions, self.question_lens: question_lens, self.is_train: is_train} 
             else: 
                 return {self.facts: feats, self.questions: questions, self.question_lens: question_lens, self.is_train: is_train}
 
@@ -5,7 +5,7 @@ from tensorflow.python.training import moving_averages
 
 def weight(name, shape, init='he', range=0.1, stddev=0.01, init_val=None, group_id=0):
     """ Get a weight variable. """
-    if init_val != None:
+    if init_val is not None:
         initializer = tf.constant_initializer(init_val)
     elif init == 'uniform':
         initializer = tf.random_uniform_initializer(-range, range)
@@ -128,6 +128,24 @@ def dropout(x, keep_prob, is_train):
     """ Apply a dropout layer. """
     return tf.cond(is_train, lambda: tf.nn.dropout(x, keep_prob), lambda: x)
 
+def rnn_cell(num_units, cell_type='gru'):
+    """ Get a GRU cell: Either the generic one or the fused (block) one. """
+    if cell_type == 'gru_block':
+        return tf.contrib.rnn.GRUBlockCell(num_units)
+    return tf.contrib.rnn.GRUCell(num_units)
+
+def bidirectional_rnn(x, num_units, cell_type='gru'):
+    """ Run a forward and a backward GRU over a sequence, and sum their states. """
+    with tf.variable_scope('Forward'):
+        forward_states, _ = tf.nn.dynamic_rnn(rnn_cell(num_units, cell_type), x, dtype=tf.float32)
+
+    with tf.variable_scope('Backward'):
+        reversed_x = tf.reverse(x, [1])
+        backward_states, _ = tf.nn.dynamic_rnn(rnn_cell(num_units, cell_type), reversed_x, dtype=tf.float32)
+        backward_states = tf.reverse(backward_states, [1])
+
+    return forward_states + backward_states
+
 def max_pool(x, k_h, k_w, s_h, s_w, name, padding='SAME'):
     """ Apply a max pooling layer. """
     return tf.nn.max_pool(x, ksize=[1, k_h, k_w, 1], strides=[1, s_h, s_w, 1], padding=padding, name=name)
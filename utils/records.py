@@ -0,0 +1,112 @@
+import os
+import io
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+from tqdm import tqdm
+
+def get_record_files(record_dir, name, num_shards):
+    """ Get the names of the shards of a dataset. """
+    return [os.path.join(record_dir, '%s-%05d-of-%05d.tfrecord' %(name, k, num_shards)) for k in range(num_shards)]
+
+def get_meta_file(record_dir, name):
+    """ Get the name of the file describing what the shards of a dataset were written from. """
+    return os.path.join(record_dir, '%s-meta.json' %(name))
+
+def digest_values(values):
+    """ Get a digest of a list of ids or file names. """
+    return hashlib.md5('\n'.join(str(v) for v in values).encode('utf-8')).hexdigest()
+
+def records_exist(record_files, meta_file, meta):
+    """ Determine whether all shards of a dataset have been written from the data described by meta. """
+    if not (os.path.exists(meta_file) and all(os.path.exists(f) for f in record_files)):
+        return False
+    with open(meta_file) as f:
+        return json.load(f) == meta
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+def encode_img(img, quality=90):
+    """ Encode a resized uint8 image as JPEG. """
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format='JPEG', quality=quality)
+    return buf.getvalue()
+
+def write_records(record_files, meta_file, meta, data, img_loader, batch_size):
+    """ Write a dataset into sharded record files. """
+    record_dir = os.path.dirname(record_files[0])
+    if record_dir and not os.path.exists(record_dir):
+        os.makedirs(record_dir)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    writers = [tf.python_io.TFRecordWriter(f+'.tmp') for f in record_files]
+
+    # Visit the questions image by image
+    image_ids, idx, img_idxs = np.unique(data.image_ids, return_index=True, return_inverse=True)
+    order = np.argsort(img_idxs, kind='mergesort')
+    starts = np.searchsorted(img_idxs[order], np.arange(len(image_ids)+1))
+
+    num_written = 0
+    for start in tqdm(list(range(0, len(image_ids), batch_size)), desc='records'):
+        end = min(start+batch_size, len(image_ids))
+        imgs = img_loader.load_imgs(data.img_files[idx[start:end]])
+        for i in range(start, end):
+            img = encode_img(imgs[i-start])
+            for k in order[starts[i]:starts[i+1]]:
+                question_len = int(data.question_lens[k])
+                answer = int(data.answers[k]) if data.answers.ndim > 0 else -1
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'image': _bytes_feature(img),
+                    'question': _int64_feature(data.questions[k][:question_len].tolist()),
+                    'question_len': _int64_feature([question_len]),
+                    'answer': _int64_feature([answer]),
+                    'question_id': _int64_feature([int(data.question_ids[k])]),
+                    'image_id': _int64_feature([int(data.image_ids[k])])}))
+                writers[num_written % len(writers)].write(example.SerializeToString())
+                num_written += 1
+
+    # The shards only get their final names once they are complete
+    for writer, f in zip(writers, record_files):
+        writer.close()
+        os.rename(f+'.tmp', f)
+
+    # The meta file marks the shards as complete, so it comes last
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+
+def parse_record(record, img_shape):
+    """ Parse a record into the tensors of a question. """
+    features = tf.parse_single_example(record, {
+        'image': tf.FixedLenFeature([], tf.string),
+        'question': tf.VarLenFeature(tf.int64),
+        'question_len': tf.FixedLenFeature([], tf.int64),
+        'answer': tf.FixedLenFeature([], tf.int64),
+        'question_id': tf.FixedLenFeature([], tf.int64),
+        'image_id': tf.FixedLenFeature([], tf.int64)})
+    img = tf.image.decode_jpeg(features['image'], channels=3)
+    img.set_shape(img_shape)
+    return {'image': img,
+            'question': tf.cast(tf.sparse_tensor_to_dense(features['question']), tf.int32),
+            'question_len': tf.cast(features['question_len'], tf.int32),
+            'answer': tf.cast(features['answer'], tf.int32),
+            'question_id': features['question_id'],
+            'image_id': features['image_id']}
+
+def read_records(record_files, img_shape, batch_size, is_train, shuffle_size=10000, num_readers=4, prefetch_size=2):
+    """ Build an input pipeline over the shards of a dataset, and return its iterator. """
+    dataset = tf.data.Dataset.from_tensor_slices(record_files)
+    if is_train:
+        dataset = dataset.shuffle(len(record_files))
+    dataset = dataset.apply(tf.contrib.data.parallel_interleave(tf.data.TFRecordDataset, cycle_length=num_readers, sloppy=is_train))
+    if is_train:
+        dataset = dataset.shuffle(shuffle_size)
+    dataset = dataset.map(lambda record: parse_record(record, img_shape), num_parallel_calls=num_readers)
+    dataset = dataset.padded_batch(batch_size, padded_shapes={'image': img_shape, 'question': [None], 'question_len': [], 'answer': [], 'question_id': [], 'image_id': []})
+    dataset = dataset.prefetch(prefetch_size)
+    return dataset.make_initializable_iterator()
@@ -0,0 +1,140 @@
+import os
+import numpy as np
+
+class ArrayStore():
+    """ Memory-mapped store of one fixed-shape array per image, indexed by image id. """
+    def __init__(self, data_file, id_file, file_list_file, shape, dtype):
+        self.data_file = data_file
+        self.id_file = id_file
+        self.file_list_file = file_list_file
+        self.shape = list(shape)
+        self.dtype = dtype
+        self.image_ids = None
+        self.img_files = None
+        self.data = None
+
+    def exists(self, image_ids=None, img_files=None):
+        """ Determine whether the store has been completely written, and holds the given images (if any). """
+        if not all(os.path.exists(f) for f in [self.data_file, self.file_list_file, self.id_file]):
+            return False
+        if image_ids is None:
+            return True
+        stored_ids, stored_files = np.load(self.id_file), np.load(self.file_list_file)
+        if len(stored_ids) == 0:
+            return len(image_ids) == 0
+        rows = np.minimum(np.searchsorted(stored_ids, image_ids), len(stored_ids)-1)
+        return bool(np.all(stored_ids[rows] == image_ids) and np.all(stored_files[rows] == np.asarray(img_files)))
+
+    def create(self, image_ids, img_files):
+        """ Allocate the store for the given images. """
+        store_dir = os.path.dirname(self.data_file)
+        if store_dir and not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        # The store is incomplete until the id file is written again
+        if os.path.exists(self.id_file):
+            os.remove(self.id_file)
+        self.image_ids, idx = np.unique(image_ids, return_index=True)
+        self.img_files = np.asarray(img_files)[idx].astype(str)
+        shape = tuple([len(self.image_ids)] + self.shape)
+        self.data = np.lib.format.open_memmap(self.data_file, mode='w+', dtype=self.dtype, shape=shape)
+
+    def write(self, start, data):
+        """ Write the arrays of the images stored from the row start onwards. """
+        self.data[start:start+len(data)] = data
+
+    def finish(self):
+        """ Flush the arrays to disk. """
+        self.data.flush()
+        np.save(self.file_list_file, self.img_files)
+        # The id file marks the store as complete, so it comes last
+        np.save(self.id_file, self.image_ids)
+
+    def load(self):
+        """ Memory-map the store. """
+        self.image_ids = np.load(self.id_file)
+        self.img_files = np.load(self.file_list_file)
+        self.data = np.load(self.data_file, mmap_mode='r')
+
+    def get_rows(self, image_ids):
+        """ Get the rows of a list of images, which must all be in the store. """
+        image_ids = np.asarray(image_ids)
+        rows = np.minimum(np.searchsorted(self.image_ids, image_ids), len(self.image_ids)-1)
+        missing = self.image_ids[rows] != image_ids
+        if np.any(missing):
+            raise KeyError("Images not in the store %s: %s" %(self.data_file, image_ids[missing][:10].tolist()))
+        return rows
+
+
+class FeatureStore(ArrayStore):
+    """ Memory-mapped store of the CNN features (facts) of a set of images, indexed by image id. """
+    def __init__(self, store_dir, name, num_facts, dim_fact, dtype=np.float32):
+        ArrayStore.__init__(self, os.path.join(store_dir, name+'_feats.npy'), os.path.join(store_dir, name+'_ids.npy'), os.path.join(store_dir, name+'_files.npy'), [num_facts, dim_fact], dtype)
+
+    def get(self, image_ids):
+        """ Fetch the features of a list of images (as float32, whatever the stored type). """
+        return np.array(self.data[self.get_rows(image_ids)], np.float32)
+
+
+class ImageStore(ArrayStore):
+    """ Memory-mapped store of the resized and cropped uint8 images of a set of images, indexed by image id. """
+    def __init__(self, store_dir, name, img_shape):
+        ArrayStore.__init__(self, os.path.join(store_dir, name+'_imgs.npy'), os.path.join(store_dir, name+'_ids.npy'), os.path.join(store_dir, name+'_files.npy'), img_shape, np.uint8)
+
+    def get(self, image_ids):
+        """ Fetch the images of a list of images. """
+        rows = self.get_rows(image_ids)
+        # A run of consecutive rows is sliced without a copy
+        if len(rows) > 0 and np.all(np.diff(rows) == 1):
+            return self.data[rows[0]:rows[-1]+1]
+        return self.data[rows]
+
+
+class FactProjection():
+    """ PCA projection of the facts of a CNN onto fewer dimensions, fit on a sample of the training images. """
+    def __init__(self, store_dir, cnn_model, dim):
+        self.save_file = os.path.join(store_dir, 'projection_%s_pca%d.npz' %(cnn_model, dim))
+        self.dim = dim
+        self.mean = None
+        self.components = None
+        self.explained_variance = None
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.count = 0
+
+    def exists(self):
+        """ Check whether the projection has been fitted and saved. """
+        return os.path.exists(self.save_file)
+
+    def accumulate(self, feats):
+        """ Accumulate the statistics of a batch of [batch_size, num_facts, dim_fact] facts, each fact being a sample. """
+        x = feats.reshape(-1, feats.shape[-1]).astype(np.float64)
+        self.sum = self.sum + x.sum(0)
+        self.sum_sq = self.sum_sq + x.T.dot(x)
+        self.count += len(x)
+
+    def fit(self):
+        """ Keep the principal directions of the accumulated facts. """
+        self.mean = self.sum / self.count
+        cov = self.sum_sq / self.count - np.outer(self.mean, self.mean)
+        eig_vals, eig_vecs = np.linalg.eigh(cov)
+        order = np.argsort(eig_vals)[::-1][:self.dim]
+        self.components = eig_vecs[:, order].T.astype(np.float32)
+        self.explained_variance = float(np.sum(eig_vals[order]) / np.sum(eig_vals))
+        self.mean = self.mean.astype(np.float32)
+
+    def save(self):
+        """ Save the projection. """
+        store_dir = os.path.dirname(self.save_file)
+        if store_dir and not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        np.savez(self.save_file, mean=self.mean, components=self.components, explained_variance=self.explained_variance)
+
+    def load(self):
+        """ Load the projection. """
+        data = np.load(self.save_file)
+        self.mean, self.components, self.explained_variance = data['mean'], data['components'], float(data['explained_variance'])
+
+    def project(self, feats):
+        """ Project a batch of [batch_size, num_facts, dim_fact] facts. """
+        shape = list(feats.shape[:-1]) + [self.dim]
+        return (feats.reshape(-1, feats.shape[-1]) - self.mean).dot(self.components.T).reshape(shape)
@@ -19,12 +19,129 @@ __version__ = '0.9'
 import json
 import datetime
 import copy
+import resource
+from six.moves import intern
+
+ANNOTATION_FIELDS = ['question_id', 'image_id', 'question_type', 'answer_type', 'answers']
+QUESTION_FIELDS = ['question_id', 'image_id', 'question', 'multiple_choices']
+
+class JSONStream:
+        """
+        Incremental reader of a JSON file whose top level is either an array, or an object with one large array.
+        The records of the array are decoded one by one from a buffer of fixed size, so that the raw JSON text
+        never sits in memory as a whole.
+        """
+        def __init__(self, file_name, chunk_size=1<<20):
+                self.file = open(file_name, 'r')
+                self.chunk_size = chunk_size
+                self.decoder = json.JSONDecoder()
+                self.buf = ''
+                self.pos = 0
+                self.eof = False
+
+        def read(self):
+                """ Append the next chunk of the file to the buffer, or return False at the end of the file. """
+                if self.eof:
+                        return False
+                chunk = self.file.read(self.chunk_size)
+                self.buf = self.buf[self.pos:] + chunk
+                self.pos = 0
+                self.eof = len(chunk) == 0
+                return not self.eof
+
+        def peek(self, skip=' \t\r\n'):
+                """ Skip the given characters and return the next one ('' at the end of the file). """
+                while True:
+                        while self.pos < len(self.buf) and self.buf[self.pos] in skip:
+                                self.pos += 1
+                        if self.pos < len(self.buf) or not self.read():
+                                return self.buf[self.pos:self.pos+1]
+
+        def expect(self, c):
+                if self.peek() != c:
+                        raise ValueError('Expected %s in %s' %(c, self.file.name))
+                self.pos += 1
+
+        def decode(self):
+                """ Decode the next JSON value. """
+                self.peek()
+                # A value ending exactly at the end of the buffer may be cut, so it is decoded again with more data
+                while True:
+                        try:
+                                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                                if end < len(self.buf) or not self.read():
+                                        self.pos = end
+                                        return value
+                        except ValueError:
+                                if not self.read():
+                                        raise
+
+        def records(self):
+                """ Yield the records of the array starting at the current position. """
+                self.expect('[')
+                if self.peek() == ']':
+                        self.pos += 1
+                        return
+                while True:
+                        yield self.decode()
+                        if self.peek() == ']':
+                                self.pos += 1
+                                return
+                        self.expect(',')
+
+        def stream(self, array_key, meta):
+                """
+                Yield the records of the array stored under array_key in the top-level object (or of the top-level array if
+                array_key is None). The other members of the top-level object are decoded into meta.
+                """
+                if array_key is None:
+                        for record in self.records():
+                                yield record
+                        self.file.close()
+                        return
+                self.expect('{')
+                while self.peek(' \t\r\n,') not in ['}', '']:
+                        key = self.decode()
+                        self.expect(':')
+                        if key == array_key:
+                                for record in self.records():
+                                        yield record
+                        else:
+                                meta[key] = self.decode()
+                self.file.close()
+
+def trim_annotation(ann):
+        """ Keep only the fields of an annotation that are used, and share the repeated strings. """
+        ann = {k: ann[k] for k in ANNOTATION_FIELDS if k in ann}
+        for k in ['question_type', 'answer_type']:
+                if k in ann:
+                        ann[k] = intern(ann[k])
+        ann['answers'] = [{'answer': intern(ans['answer']), 'answer_id': ans['answer_id']} for ans in ann['answers']]
+        return ann
+
+def trim_question(ques):
+        """ Keep only the fields of a question that are used. """
+        return {k: ques[k] for k in QUESTION_FIELDS if k in ques}
+
+def load_json_array(file_name, array_key, trim=None):
+        """
+        Stream a JSON file and return its top-level object with the array under array_key (or the top-level array if
+        array_key is None). Each record of the array is trimmed as soon as it is decoded.
+        """
+        meta = {}
+        records = [trim(r) if trim else r for r in JSONStream(file_name).stream(array_key, meta)]
+        if array_key is None:
+                return records
+        meta[array_key] = records
+        return meta
 
 class VQA:
-        def __init__(self, annotation_file=None, question_file=None):
+        def __init__(self, annotation_file=None, question_file=None, max_ques_len=None, max_ans_len=None):
                 """
                 Constructor of VQA helper class for reading and visualizing questions and answers.
                 :param annotation_file (str): location of VQA annotation file
+                       max_ques_len (int)    : if given with max_ans_len, filter the questions while indexing them (see filter_and_index)
+                       max_ans_len (int)     : if given with max_ques_len, filter the answers while indexing them (see filter_and_index)
                 :return:
                 """
                 # load dataset
@@ -37,13 +154,16 @@ class VQA:
                 if not annotation_file == None and not question_file == None:
                         print('loading VQA annotations and questions into memory...')
                         time_t = datetime.datetime.utcnow()
-                        dataset = json.load(open(annotation_file, 'r'))
-                        questions = json.load(open(question_file, 'r'))
+                        dataset = load_json_array(annotation_file, 'annotations', trim_annotation)
+                        questions = load_json_array(question_file, 'questions', trim_question)
                         print(datetime.datetime.utcnow() - time_t)
                         self.dataset = dataset
                         self.questions = questions
-                        self.process_dataset()
-                        self.createIndex()
+                        if max_ques_len is not None and max_ans_len is not None:
+                                self.filter_and_index(max_ques_len, max_ans_len)
+                        else:
+                                self.process_dataset()
+                                self.createIndex()
 
         def createIndex(self):
                 # create index
@@ -154,7 +274,7 @@ class VQA:
                 :return: res (obj)         : result api object
                 """
                 res = VQA()
-                res.questions = json.load(open(quesFile))
+                res.questions = load_json_array(quesFile, 'questions', trim_question)
                 res.dataset['info'] = copy.deepcopy(self.questions['info'])
                 res.dataset['task_type'] = copy.deepcopy(self.questions['task_type'])
                 res.dataset['data_type'] = copy.deepcopy(self.questions['data_type'])
@@ -163,7 +283,7 @@ class VQA:
 
                 print('Loading and preparing results...     ')
                 time_t = datetime.datetime.utcnow()
-                anns    = json.load(open(resFile))
+                anns    = load_json_array(resFile, None)
                 assert type(anns) == list, 'results is not an array of objects'
                 annsQuesIds = [ann['question_id'] for ann in anns]
                 assert set(annsQuesIds) == set(self.getQuesIds()), \
@@ -214,21 +334,74 @@ class VQA:
 
         def process_dataset(self):
                 for ann in self.dataset['annotations']:
-                    count = {}
-                    for ans in ann['answers']:
-                        ans['answer'] = ans['answer'].lower()
-                        count[ans['answer']] = count.get(ans['answer'], 0) + 1
-                    sorted_ans = sorted(list(count.items()), key=lambda x: x[1], reverse=True)                   
-                    best_ans, best_ans_count = sorted_ans[0]
-                    ann['best_answer'] = best_ans
-                    ann['best_answer_count'] = best_ans_count
+                    self.set_best_answer(ann)
                 
                 for ques in self.questions['questions']:
-                    q = ques['question']
-                    q = q.replace('?', '')
-                    q = q.lower().split()
-                    q = [x for x in q if len(x)>0]
-                    ques['question'] = ' '.join(q)
+                    ques['question'] = self.normalize_question(ques['question'])
+
+        def set_best_answer(self, ann):
+                """ Lowercase the answers of an annotation, and set its most frequent answer and the number of times it was given. """
+                count = {}
+                for ans in ann['answers']:
+                    ans['answer'] = intern(ans['answer'].lower())
+                    count[ans['answer']] = count.get(ans['answer'], 0) + 1
+                sorted_ans = sorted(list(count.items()), key=lambda x: x[1], reverse=True)                   
+                best_ans, best_ans_count = sorted_ans[0]
+                ann['best_answer'] = best_ans
+                ann['best_answer_count'] = best_ans_count
+
+        def normalize_question(self, q):
+                """ Remove the question marks from a question, and lowercase it. """
+                q = q.replace('?', '')
+                q = q.lower().split()
+                q = [x for x in q if len(x)>0]
+                return ' '.join(q)
+
+        def filter_and_index(self, max_ques_len, max_ans_len):
+                """
+                Normalize, filter and index the questions and answers in one pass. It keeps the same questions as
+                process_dataset, filter_by_ques_len(max_ques_len), filter_by_ans_len(max_ans_len) and createIndex do.
+                :param max_ques_len (int) : maximum number of words in a question
+                       max_ans_len (int)  : maximum number of words in the best answer
+                :return:
+                """
+                print('filtering and creating index...')
+                time_t = datetime.datetime.utcnow()
+                keep_ques = set()
+                for ques in self.questions['questions']:
+                    ques['question'] = self.normalize_question(ques['question'])
+                    if len(ques['question'].split(' '))<=max_ques_len:
+                        keep_ques.add(ques['question_id'])
+
+                qa = {}
+                imgToQA = {}
+                annotations = []
+                for ann in self.dataset['annotations']:
+                    if ann['question_id'] not in keep_ques:
+                        continue
+                    self.set_best_answer(ann)
+                    if len(ann['best_answer'].split(' '))<=max_ans_len and ann['best_answer_count']>=5:
+                        annotations.append(ann)
+                        qa[ann['question_id']] = ann
+                        imgToQA.setdefault(ann['image_id'], []).append(ann)
+
+                qqa = {}
+                questions = []
+                max_ques_len_kept = 0
+                for ques in self.questions['questions']:
+                    if ques['question_id'] in qa:
+                        questions.append(ques)
+                        qqa[ques['question_id']] = ques
+                        max_ques_len_kept = max(max_ques_len_kept, len(ques['question'].split(' ')))
+
+                self.dataset['annotations'] = annotations
+                self.questions['questions'] = questions
+                self.qa = qa
+                self.qqa = qqa
+                self.imgToQA = imgToQA
+                self.max_ques_len = max_ques_len_kept
+                peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+                print('index created! (t=%0.2fs, peak memory=%.0fMB)'%((datetime.datetime.utcnow() - time_t).total_seconds(), peak_rss))
                
         def filter_by_ques_len(self, max_ques_len):
                 print("Removing extremely long questions...")
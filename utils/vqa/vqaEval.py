@@ -6,18 +6,33 @@ __author__='aagrawal'
 # (https://github.com/tylin/coco-caption/blob/master/pycocoevalcap/eval.py).
 import sys
 import re
+import multiprocessing
 from tqdm import tqdm
 
+# Answer normalizer of a worker process (see VQAEval.normalizeAll)
+_normalizer = None
+
+def _initNormalizer():
+        global _normalizer
+        _normalizer = VQAEval(None, None)
+
+def _normalizeGTAnswers(answers):
+        return [_normalizer.processPunctuation(ans) for ans in answers]
+
+def _normalizeResAnswers(answers):
+        return [_normalizer.normalizeResAnswer(ans) for ans in answers]
+
 class VQAEval:
-        def __init__(self, vqa, vqaRes, n=2):
+        def __init__(self, vqa, vqaRes, n=2, numWorkers=1):
                 self.n            = n
+                self.numWorkers   = numWorkers
                 self.accuracy     = {}
                 self.evalQA       = {}
                 self.evalQuesType = {}
                 self.evalAnsType  = {}
                 self.vqa          = vqa
                 self.vqaRes       = vqaRes
-                self.params       = {'question_id': vqa.getQuesIds()}
+                self.params       = {'question_id': vqa.getQuesIds() if vqa is not None else []}
                 self.contractions = {"aint": "ain't", "arent": "aren't", "cant": "can't", "couldve": "could've", "couldnt": "couldn't", \
                                      "couldn'tve": "couldn’t’ve", "couldnt’ve": "couldn’t’ve", "didnt": "didn’t", "doesnt": "doesn’t", "dont": "don’t", "hadnt": "hadn’t", \
                                      "hadnt’ve": "hadn’t’ve", "hadn'tve": "hadn’t’ve", "hasnt": "hasn’t", "havent": "haven’t", "hed": "he’d", "hed’ve": "he’d’ve", \
@@ -75,28 +90,25 @@ class VQAEval:
                 accQA       = []
                 accQuesType = {}
                 accAnsType  = {}
+                # Normalize each distinct answer once. The answers of the ground truth only need it when they disagree
+                gtStrings = set()
+                for quesId in quesIds:
+                        gtAnswers = [ans['answer'] for ans in gts[quesId]['answers']]
+                        if len(set(gtAnswers)) > 1:
+                                gtStrings.update(gtAnswers)
+                resStrings = set(res[quesId]['answer'] for quesId in quesIds)
+                gtNorm, resNorm = self.normalizeAll(list(gtStrings), list(resStrings))
+
                 print("computing accuracy")
                 step = 0
                 for quesId in tqdm(quesIds):
-                        resAns      = res[quesId]['answer']
-                        resAns      = resAns.replace('\n', ' ')
-                        resAns      = resAns.replace('\t', ' ')
-                        resAns      = resAns.strip()
-                        resAns      = self.processPunctuation(resAns)
-                        resAns      = self.processDigitArticle(resAns)
-                        gtAcc  = []
+                        resAns      = resNorm[res[quesId]['answer']]
                         gtAnswers = [ans['answer'] for ans in gts[quesId]['answers']]
                         if len(set(gtAnswers)) > 1: 
-                                for ansDic in gts[quesId]['answers']:
-                                        ansDic['answer'] = self.processPunctuation(ansDic['answer'])
-                        for gtAnsDatum in gts[quesId]['answers']:
-                                otherGTAns = [item for item in gts[quesId]['answers'] if item!=gtAnsDatum]
-                                matchingAns = [item for item in otherGTAns if item['answer']==resAns]
-                                acc = min(1, float(len(matchingAns))/3)
-                                gtAcc.append(acc)
+                                gtAnswers = [gtNorm[ans] for ans in gtAnswers]
                         quesType    = gts[quesId]['question_type']
                         ansType     = gts[quesId]['answer_type']
-                        avgGTAcc = float(sum(gtAcc))/len(gtAcc)
+                        avgGTAcc = self.computeAccuracy(resAns, gtAnswers)
                         accQA.append(avgGTAcc)
                         if quesType not in accQuesType:
                                 accQuesType[quesType] = []
@@ -114,6 +126,38 @@ class VQAEval:
 
                 self.showAccuracy(accQA, accQuesType, accAnsType)
         
+        def computeAccuracy(self, resAns, gtAnswers):
+                """ Get the accuracy of a normalized answer against the normalized ground-truth answers. """
+                numMatches = gtAnswers.count(resAns)
+                gtAcc = [min(1, float(numMatches - (gtAns == resAns))/3) for gtAns in gtAnswers]
+                return float(sum(gtAcc))/len(gtAcc)
+
+        def normalizeAll(self, gtStrings, resStrings):
+                """ Normalize the distinct ground-truth and result answers, in a pool of numWorkers processes if numWorkers > 1. """
+                if self.numWorkers <= 1:
+                        gtNorm = [self.processPunctuation(ans) for ans in gtStrings]
+                        resNorm = [self.normalizeResAnswer(ans) for ans in resStrings]
+                else:
+                        # Only the normalization runs in the pool, the scoring stays in this process
+                        pool = multiprocessing.Pool(self.numWorkers, _initNormalizer)
+                        gtNorm = sum(pool.map(_normalizeGTAnswers, self.split(gtStrings)), [])
+                        resNorm = sum(pool.map(_normalizeResAnswers, self.split(resStrings)), [])
+                        pool.close()
+                        pool.join()
+                return dict(zip(gtStrings, gtNorm)), dict(zip(resStrings, resNorm))
+
+        def split(self, strings):
+                chunkSize = max(1, -(-len(strings) // (4*self.numWorkers)))
+                return [strings[i:i+chunkSize] for i in range(0, len(strings), chunkSize)]
+
+        def normalizeResAnswer(self, resAns):
+                resAns      = resAns.replace('\n', ' ')
+                resAns      = resAns.replace('\t', ' ')
+                resAns      = resAns.strip()
+                resAns      = self.processPunctuation(resAns)
+                resAns      = self.processDigitArticle(resAns)
+                return resAns
+
         def processPunctuation(self, inText):
                 outText = inText
                 for p in self.punct:
@@ -186,3 +230,56 @@ class VQAEval:
                 text = "\rFinshed Percent: [{0}] {1}% {2}".format( "#"*block + "-"*(barLength-block), int(progress*100), status)
                 print(text)
 
+
+
+class VQAOnlineEval(VQAEval):
+        """
+        Evaluator which scores the answers batch by batch, as they are predicted. The accuracy of the questions answered
+        so far can be read at any point, and is the same as VQAEval gives for them.
+        """
+        def __init__(self, vqa, n=2):
+                VQAEval.__init__(self, vqa, None, n, 1)
+                self.accQA       = []
+                self.accQuesType = {}
+                self.accAnsType  = {}
+                self.gtNorm      = {}
+                self.resNorm     = {}
+
+        def update(self, quesIds, answers):
+                """
+                Score a batch of answers.
+                :param quesIds (int array) : question ids of the batch
+                       answers (str array) : predicted answers to these questions
+                :return: accuracy of the questions answered so far (see getAccuracy)
+                """
+                for quesId, resAns in zip(quesIds, answers):
+                        gt = self.vqa.qa[quesId]
+                        if resAns not in self.resNorm:
+                                self.resNorm[resAns] = self.normalizeResAnswer(resAns)
+                        resAns = self.resNorm[resAns]
+                        gtAnswers = [ans['answer'] for ans in gt['answers']]
+                        if len(set(gtAnswers)) > 1:
+                                for ans in gtAnswers:
+                                        if ans not in self.gtNorm:
+                                                self.gtNorm[ans] = self.processPunctuation(ans)
+                                gtAnswers = [self.gtNorm[ans] for ans in gtAnswers]
+
+                        quesType = gt['question_type']
+                        ansType  = gt['answer_type']
+                        avgGTAcc = self.computeAccuracy(resAns, gtAnswers)
+                        self.accQA.append(avgGTAcc)
+                        self.accQuesType.setdefault(quesType, []).append(avgGTAcc)
+                        self.accAnsType.setdefault(ansType, []).append(avgGTAcc)
+                        self.setEvalQA(quesId, avgGTAcc)
+                        self.setEvalQuesType(quesId, quesType, avgGTAcc)
+                        self.setEvalAnsType(quesId, ansType, avgGTAcc)
+                return self.getAccuracy()
+
+        def getAccuracy(self):
+                """ Get the overall, per-question-type and per-answer-type accuracies of the questions answered so far. """
+                if len(self.accQA) > 0:
+                        self.setAccuracy(self.accQA, self.accQuesType, self.accAnsType)
+                return self.accuracy
+
+        def numEvaluated(self):
+                return len(self.accQA)
@@ -1,5 +1,7 @@
 import os
+import io
 import json
+import hashlib
 import numpy as np
 import six.moves.cPickle as pickle
 
@@ -11,6 +13,7 @@ class WordTable():
         self.num_words = 0
         self.word_count = {}
         self.word_freq = []
+        self.word_vecs = None
         self.dim_embed = dim_embed
         self.max_sent_len = max_sent_len
         self.save_file = save_file
@@ -55,22 +58,168 @@ class WordTable():
         indices[:len(words)] = words
         return indices, len(words)
 
+    def symbolize_sents(self, sents):
+        """ Translate a list of sentences (truncated to max_sent_len) into a matrix of the indicies of their words, and get their lengths. """
+        words = [sent.lower().split(' ')[:self.max_sent_len] for sent in sents]
+        lens = np.array([len(w) for w in words], np.int32)
+        word2idx = self.word2idx
+        flat_indices = np.array([word2idx.get(w, 0) for ws in words for w in ws], np.int32)
+        indices = np.zeros((len(sents), self.max_sent_len), np.int32)
+        indices[np.arange(self.max_sent_len) < lens[:, None]] = flat_indices
+        return indices, lens
+
+    def digest(self):
+        """ Get a digest of the vocabulary, which identifies the indices it assigns to the words. """
+        return hashlib.md5('\n'.join(self.idx2word).encode('utf-8')).hexdigest()
+
+    def get_files(self):
+        """ Get the files storing the word vectors, the word frequencies and the vocabulary. """
+        prefix = os.path.splitext(self.save_file)[0]
+        return prefix+'_vecs.npy', prefix+'_freq.npy', prefix+'_vocab.txt'
+
+    def exists(self):
+        """ Check whether the word table has been saved (in either format). """
+        return os.path.exists(self.get_files()[2]) or os.path.exists(self.save_file)
+
     def save(self):
-        """ Save the word table to pickle. """
-        pickle.dump([self.idx2word, self.word2idx, self.word2vec, self.num_words, self.word_freq], open(self.save_file, 'wb'))
+        """ Save the word table as a matrix of the word vectors, an array of the word frequencies and a list of the words. """
+        vecs_file, freq_file, vocab_file = self.get_files()
+        self.word_vecs = np.array([self.word2vec[w] for w in self.idx2word], np.float32)
+        np.save(vecs_file, self.word_vecs)
+        np.save(freq_file, np.array(self.word_freq, np.float32))
+        # The list of the words marks the table as complete, so it comes last
+        with io.open(vocab_file, 'w', encoding='utf-8', newline='\n') as f:
+            for w in self.idx2word:
+                f.write(w+'\n')
 
     def load(self):
-        """ Load the word table from pickle. """
-        self.idx2word, self.word2idx, self.word2vec, self.num_words, self.word_freq = pickle.load(open(self.save_file, 'rb'))
+        """ Load the word table, with its word vectors memory-mapped. """
+        vecs_file, freq_file, vocab_file = self.get_files()
+        # Word tables pickled by older versions
+        if not os.path.exists(vocab_file):
+            self.idx2word, self.word2idx, self.word2vec, self.num_words, self.word_freq = pickle.load(open(self.save_file, 'rb'))
+            self.word_vecs = np.array([self.word2vec[w] for w in self.idx2word], np.float32)
+            return
+
+        with io.open(vocab_file, encoding='utf-8', newline='\n') as f:
+            self.idx2word = [w.rstrip('\n') for w in f]
+        self.word2idx = {w: i for i, w in enumerate(self.idx2word)}
+        self.num_words = len(self.idx2word)
+        self.word_vecs = np.load(vecs_file, mmap_mode='r')
+        self.word_freq = np.load(freq_file)
+        self.word2vec = {}
 
     def load_glove(self, glove_dir):
-        """ Initialize the word embedding with GloVe data. """
-        glove_file = os.path.join(glove_dir, 'glove.6B.'+str(self.dim_embed)+'d.txt')
-        print("Loading GloVe data from %s" %(glove_file))
-        with open(glove_file) as f:
-            for line in f:
-                l = line.split()
-                self.word2vec[l[0]] = [float(x)*0.05 for x in l[1:]]
-        print("GloVe data loaded")
+        """ Initialize the word embedding of the words in the vocabulary with GloVe data. """
+        glove_file = os.path.join(glove_dir, 'glove.6B.'+str(self.dim_embed)+'d')
+        if not os.path.exists(glove_file+'.npy'):
+            convert_glove(glove_file+'.txt', glove_file+'.npy', glove_file+'.vocab')
+
+        print("Loading GloVe data from %s.npy" %(glove_file))
+        with io.open(glove_file+'.vocab', encoding='utf-8', newline='\n') as f:
+            glove_idx = {w.rstrip('\n'): i for i, w in enumerate(f)}
+        words = [w for w in self.word2idx if w in glove_idx]
+        vecs = np.load(glove_file+'.npy', mmap_mode='r')
+        rows = np.array([glove_idx[w] for w in words], np.int64)
+        order = np.argsort(rows)
+        word_vecs = np.array(vecs[rows[order]]) * 0.05
+        for i, k in enumerate(order):
+            self.word2vec[words[k]] = word_vecs[i]
+        print("GloVe data loaded for %d words" %(len(words)))
+
+
+class AnswerTable():
+    def __init__(self, max_answers, save_file):
+        self.idx2ans = []
+        self.ans2idx = {}
+        self.ans_count = []
+        self.ans_freq = []
+        self.num_answers = 0
+        self.max_answers = max_answers
+        self.save_file = save_file
+
+    def build(self, answers):
+        """ Build the answer vocabulary from the max_answers most frequent training answers (all of them if max_answers is 0). """
+        count = {}
+        for ans in answers:
+            count[ans] = count.get(ans, 0) + 1
+        sorted_ans = sorted(count.items(), key=lambda x: (-x[1], x[0]))
+        if self.max_answers > 0:
+            sorted_ans = sorted_ans[:self.max_answers]
+        self.set_answers([a for a, _ in sorted_ans], [c for _, c in sorted_ans])
+
+    def set_answers(self, idx2ans, ans_count):
+        """ Set the answers (most frequent first) with their counts. """
+        self.idx2ans = idx2ans
+        self.ans2idx = {a: i for i, a in enumerate(idx2ans)}
+        self.num_answers = len(idx2ans)
+        self.ans_count = np.array(ans_count, np.float32)
+        self.compute_freq()
+
+    def compute_freq(self):
+        """ Compute the frequency of each answer. """
+        self.ans_freq = self.ans_count / np.sum(self.ans_count)
+        self.ans_freq = np.log(self.ans_freq)
+        self.ans_freq -= np.max(self.ans_freq)
+
+    def digest(self):
+        """ Get a digest of the answers in their order. """
+        return hashlib.md5('\n'.join(self.idx2ans).encode('utf-8')).hexdigest()
+
+    def answer_to_index(self, ans):
+        """ Translate an answer into its index, or -1 if it is not in the vocabulary. """
+        return self.ans2idx.get(ans, -1)
+
+    def saved_max_answers(self):
+        """ Get the max_answers the saved table was built with, or None if it does not say (older tables). """
+        with io.open(self.save_file, encoding='utf-8', newline='\n') as f:
+            line = f.readline().rstrip('\n')
+        if line.startswith(u'#max_answers\t'):
+            return int(line.split('\t', 1)[1])
+        return None
+
+    def exists(self):
+        """ Check whether the answer table has been saved with the same max_answers. """
+        return os.path.exists(self.save_file) and self.saved_max_answers() == self.max_answers
+
+    def save(self):
+        """ Save the max_answers the table was built with, then the answers with their counts, one per line. """
+        with io.open(self.save_file, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(u'#max_answers\t%d\n' %(self.max_answers))
+            for a, c in zip(self.idx2ans, self.ans_count):
+                f.write(u'%s\t%d\n' %(a, c))
+
+    def load(self):
+        """ Load the answers with their counts. """
+        saved_max_answers = self.saved_max_answers()
+        if saved_max_answers is not None and saved_max_answers != self.max_answers:
+            raise ValueError("The answer table %s was built with max_answers=%d, not %d." %(self.save_file, saved_max_answers, self.max_answers))
+        idx2ans, ans_count = [], []
+        with io.open(self.save_file, encoding='utf-8', newline='\n') as f:
+            for i, line in enumerate(f):
+                if i == 0 and saved_max_answers is not None:
+                    continue
+                a, c = line.rstrip('\n').rsplit('\t', 1)
+                idx2ans.append(a)
+                ans_count.append(int(c))
+        self.set_answers(idx2ans, ans_count)
 
 
+def convert_glove(glove_txt_file, glove_npy_file, glove_vocab_file):
+    """ Convert a GloVe text file into a matrix of the word vectors and a file listing the words (one per row). """
+    print("Converting GloVe data from %s" %(glove_txt_file))
+    with io.open(glove_txt_file, encoding='utf-8') as f:
+        num_words = sum(1 for _ in f)
+        f.seek(0)
+        dim_embed = len(f.readline().rstrip().split(' ')) - 1
+        f.seek(0)
+        vecs = np.lib.format.open_memmap(glove_npy_file+'.tmp', mode='w+', dtype=np.float32, shape=(num_words, dim_embed))
+        with io.open(glove_vocab_file, 'w', encoding='utf-8', newline='\n') as vocab:
+            for i, line in enumerate(f):
+                l = line.rstrip().split(' ')
+                vocab.write(l[0]+'\n')
+                vecs[i] = np.array(l[1:], np.float32)
+    vecs.flush()
+    del vecs
+    os.rename(glove_npy_file+'.tmp', glove_npy_file)
+    print("GloVe data converted")